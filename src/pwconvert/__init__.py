@@ -4,6 +4,9 @@ from .distribute import app as dist_app
 from .add_original_ext import app as ext_app
 from .copy_source_files import app as copy_app 
 from .validate import app as validate_app
+from .worker import app as worker_app
+from .plan import app as plan_app
+from .identify import app as identify_app
 
 
 app = typer.Typer()
@@ -13,6 +16,9 @@ app.add_typer(dist_app)
 app.add_typer(ext_app)
 app.add_typer(copy_app)
 app.add_typer(validate_app)
+app.add_typer(worker_app)
+app.add_typer(plan_app)
+app.add_typer(identify_app)
 
 
 @app.callback()
@@ -23,4 +23,10 @@ if user_cfg_path.exists():
     with open(user_cfg_path, "r") as content:
         user_cfg = yaml.load(content)
     if user_cfg:
-        cfg.update(user_cfg)
+        # Merge sections like `unoserver`, so that a user only needs
+        # to set the options that should be changed
+        for key, value in user_cfg.items():
+            if isinstance(value, dict) and isinstance(cfg.get(key), dict):
+                cfg[key].update(value)
+            else:
+                cfg[key] = value
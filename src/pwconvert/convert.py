@@ -13,13 +13,20 @@
 
 from __future__ import annotations
 import os
+import atexit
+import json
 import shutil
 import datetime
 import time
 import textwrap
+import queue
+import signal
+import threading
 import psutil
 from pathlib import Path
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool, Process, Event
+from multiprocessing.pool import ThreadPool
+from multiprocessing.managers import SyncManager
 from math import ceil
 import typer
 
@@ -28,8 +35,17 @@ import petl as etl
 
 from .storage import Storage
 from .file import File
-from .util import (remove_file, start_uno_server, make_filelist,
-                   filelist_to_storage, run_shell_cmd)
+from .progress import ConversionProgress
+from .engine import CommandEngine
+from . import idcache
+from .siegfried import (server_address, start_sf_server, identify_files,
+                        get_match)
+from .scheduler import (Scheduler, get_converter, concurrency_class,
+                        get_limits, make_slots, set_slots, uno_slots, has_slots,
+                        longest_first, adaptive_bounds, watch_load,
+                        learn_timeouts, set_timeouts)
+from .util import (remove_file, start_uno_server, scan_to_storage,
+                   run_shell_cmd, watch_uno_servers, kill_children, checksum)
 from .config import cfg, converters
 
 cwd = os.getcwd()
@@ -49,8 +65,32 @@ def limit_cpu():
     p.nice(19)
 
 
-def report_error(e):
-    print(f"Error in listener: {e}")
+def ignore_sigint():
+    "lets the main process decide how to stop on Ctrl-C"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def ignore_signals():
+    "lets the main process decide how to stop on Ctrl-C and SIGTERM"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def init_worker(slots, stopping, timeouts):
+    "is called at every process start"
+    ignore_sigint()
+
+    # SIGTERM sent to the process group is left to the main process, so
+    # that conversions in progress can finish. The pool also stops the
+    # workers with SIGTERM, which they obey once `stopping` is set
+    def on_sigterm(signum, frame):
+        if stopping.is_set():
+            os._exit(1)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    limit_cpu()
+    set_slots(slots)
+    set_timeouts(timeouts)
 
 
 @app.command()
@@ -95,6 +135,31 @@ def convert(
             number of files in each. NOTE: Only distributes files directly
             under the source folder
             """
+    ),
+    max_in_flight: int = typer.Option(
+        default=cfg['max-in-flight'],
+        help="""
+            Max number of files submitted to the workers at a time.
+            Defaults to twice the number of CPUs
+            """
+    ),
+    order: str = typer.Option(
+        default=cfg['order'],
+        help="""
+            Order to convert files in: path, size (largest first) or cost
+            (longest estimated conversion time first)
+            """
+    ),
+    resume: bool = typer.Option(
+        default=False,
+        help="Continue the last run, if it was interrupted"
+    ),
+    adaptive: bool = typer.Option(
+        default=False,
+        help="""
+            Adjust number of simultaneous conversions to available memory,
+            swapping and load, within the bounds in application.yml
+            """
     )
 ) -> None:
     """
@@ -106,6 +171,9 @@ def convert(
     .db extension.
     --status can be one of: accepted, converted, deleted, failed, protected,
     skipped, timeout, new.
+    With --resume, the filters of the interrupted run are used, and files
+    that were being converted when it stopped are cleaned up and converted
+    again.
     """
 
     if source[0] != '/':
@@ -113,6 +181,11 @@ def convert(
     if dest and dest[0] != '/':
         dest = os.path.join(cwd, dest)
 
+    if distribute and order != 'path':
+        # Distribution into subfolders depends on files coming in path order
+        console.print("--distribute requires --order path", style="bold red")
+        return False
+
     is_svn_repo = False
     if dest is None:
         dest = source
@@ -125,19 +198,30 @@ def convert(
     Path(dest).mkdir(parents=True, exist_ok=True)
     ts = datetime.datetime.now()
 
-    if os.path.isdir('/tmp/convert'):
-        shutil.rmtree('/tmp/convert')
-
     if not db:
         db = dest.rstrip('/') + '.db'
 
     with Storage(db) as store:
-        first_run = store.get_row_count() == 0
-        if first_run:
-            make_filelist(source)
+        crashed = store.get_interrupted_run()
+        if resume and not crashed:
+            console.print("Found no interrupted run to resume",
+                          style="bold red")
+            return False
+        elif resume:
+            options = crashed['options']
+            mime, puid, ext = options['mime'], options['puid'], options['ext']
+            status, retry = options['status'], options['retry']
+            reconvert = options['reconvert']
+            identify_only = options['identify_only']
+            order = options['order']
+            ts = crashed['started']
+        elif os.path.isdir('/tmp/convert') and not crashed:
+            # Originals of an interrupted run are kept until it's resumed
+            shutil.rmtree('/tmp/convert')
 
+        first_run = store.get_row_count() == 0
         if first_run:
-            filelist_to_storage(source, store)
+            scan_to_storage(source, store)
             status = 'new'
 
         if filecheck:
@@ -145,9 +229,12 @@ def convert(
             if res == 'cancelled':
                 return False
 
+        # Files extracted from archives during the run are submitted as
+        # they're registered, and not read again with the other rows
         conds, params = store.get_conds(mime=mime, puid=puid, status=status,
                                         reconvert=reconvert, timestamp=ts,
-                                        ext=ext, retry=retry)
+                                        ext=ext, retry=retry,
+                                        max_id=store.get_max_id())
 
         count_remains = store.get_row_count(conds, params)
 
@@ -156,6 +243,9 @@ def convert(
             msg = f"Identifies {count_remains} files. "
         else:
             msg = f"Converts {count_remains} files. "
+        if crashed and not resume:
+            msg += (f"The run started {crashed['started']} was interrupted. "
+                    "Use --resume to continue it. ")
         if dest == source and keep_originals is False and not identify_only:
             msg += ("You have chosen to convert files within source folder "
                     "and not keep original files. This deletes original files "
@@ -181,34 +271,272 @@ def convert(
 
         console.print("Converting files..", style="bold cyan")
 
-        table = store.get_rows(conds, params)
-        total_count = len(table) - 1
+        if order == 'cost':
+            rows = longest_first(store, conds, params)
+        else:
+            rows = store.iter_rows(conds, params, order)
+
+        if resume:
+            run_id = crashed['id']
+            store.resume_run(run_id)
+            in_progress = store.get_in_progress(crashed)
+        else:
+            if crashed:
+                store.finish_run(crashed['id'], 'abandoned')
+            options = {'mime': mime, 'puid': puid, 'ext': ext,
+                       'status': status, 'retry': retry,
+                       'reconvert': reconvert, 'identify_only': identify_only,
+                       'order': order}
+            run_id = store.add_run(ts, options)
+            in_progress = set()
 
-        manager = Manager()
-        q = manager.Queue()
-        pool = Pool(None, limit_cpu)
-        jobs = []
         t0 = time.time()
-        count = {
-            'finished': manager.Value('i', 0),
-            'total': manager.Value('i', total_count),
-            'failed': manager.Value('i', 0),
-            'skipped': manager.Value('i', 0)
-        }
-
-        # put listener to work first
-        pool.apply_async(listener, (q, db), error_callback=report_error)
-
-        n = 0
-        conds, params = store.get_conds(finished=True, original=True)
-        i = store.get_row_count(conds, params)
-        subfolder = ''
-        num_files = len(os.listdir(source))
-        last_folder = '.'
-        for row in etl.dicts(table):
-            n += 1
-            file = File(row, identify_only)
-            file.set_progress(f"{n}/{total_count}")
+        result = convert_rows(
+            store, rows, count_remains, db, source, dest, orig_ext, debug,
+            set_source_ext, identify_only, keep_originals, reconvert,
+            distribute, max_in_flight, is_svn_repo, run_id, in_progress, ts,
+            adaptive
+        )
+        store.finish_run(run_id, result)
+        if result == 'interrupted':
+            console.print("Use --resume to continue the run",
+                          style="bold orange1")
+        print_summary(store, db, ts, t0, identify_only)
+
+
+def convert_rows(store, rows, total_count, db, source, dest, orig_ext=False,
+                 debug=False, set_source_ext=False, identify_only=False,
+                 keep_originals=False, reconvert=False, distribute=None,
+                 max_in_flight=None, is_svn_repo=False, run_id=None,
+                 in_progress=(), run_started=None, adaptive=False,
+                 lease=None):
+    """
+    Convert rows with a pool of workers, and log the results to db
+
+    Rows are marked with `run_id` before they are handed out. Rows in
+    `in_progress` were being converted when the run `run_started` was
+    interrupted, and are cleaned up before conversion.
+    With `adaptive`, the number of simultaneous conversions follows the
+    system load instead of `max_in_flight`. Files extracted from archives
+    are registered and converted as new jobs, leased with `lease` as
+    owner and seconds when several workers share the database
+    """
+
+    manager = SyncManager()
+    manager.start(ignore_signals)
+    q = manager.Queue()
+    limits = get_limits()
+    slots = make_slots(limits)
+    # Timeouts are set by the workers once the file is identified
+    timeouts = None
+    if cfg['timeouts']['learn'] and not identify_only:
+        timeouts = learn_timeouts(store)
+    threaded = cfg['engine'] == 'async'
+    if adaptive:
+        bounds = adaptive_bounds(cfg['threads'] if threaded else None)
+        workers = bounds[1]
+    else:
+        workers = cfg['threads'] if threaded else None
+
+    if threaded:
+        # Conversions run in threads of this process, while their
+        # commands run in the event loop of the engine
+        engine = CommandEngine()
+        engine.start()
+        limit_cpu()
+        set_slots(slots)
+        set_timeouts(timeouts)
+        pool = ThreadPool(workers)
+    else:
+        stopping = Event()
+        pool = Pool(workers, init_worker, (slots, stopping, timeouts))
+        # The pool is terminated at exit if the run fails
+        atexit.register(stopping.set)
+
+    # restart unoserver instances that hang or crash during the run
+    stop_threads = threading.Event()
+    watchdog = threading.Thread(
+        target=watch_uno_servers,
+        args=(uno_slots(slots), stop_threads,
+              cfg['unoserver']['watchdog-interval']),
+        daemon=True
+    )
+    watchdog.start()
+
+    # put listener to work first, in its own process so that it
+    # doesn't occupy one of the workers
+    writer = Process(target=listener, args=(q, db))
+    writer.start()
+
+    # Only keep `max_in_flight` files in the pool at a time, and fetch
+    # more rows from the database as the workers finish
+    if adaptive:
+        # Every file in the pool is converted at once, so that the number
+        # of files in the pool is the number of simultaneous conversions
+        max_in_flight = max(bounds[0], min(os.cpu_count(), bounds[1]))
+    elif threaded:
+        max_in_flight = max_in_flight or workers
+    else:
+        max_in_flight = max_in_flight or 2 * os.cpu_count()
+    progress = ConversionProgress(
+        total_count, "Identifying" if identify_only else "Converting"
+    )
+
+    # Files extracted from archives by the workers, to be registered
+    # and converted as jobs of their own
+    members = queue.Queue()
+    # Files identified by the workers, to be submitted again in their
+    # concurrency class
+    deferred = queue.Queue()
+
+    # Files with the same checksum and converter are converted once.
+    # The first file is converted while the copies wait, and the copies
+    # then reuse its converted file. Copies found after the first file is
+    # finished look up its converted file in the database, so only
+    # files in flight are held here
+    dedup = cfg['dedup']['enabled'] and not identify_only
+    since = run_started or datetime.datetime.now()
+    first_ids = {}
+    copies = {}
+    # Id and converted file of the first files, when they're finished
+    converted = queue.Queue()
+
+    def job_done(result):
+        if result[0] == 'deferred':
+            deferred.put(result[1])
+            return
+        status, size, paths, source_id, output = result
+        if paths:
+            members.put((source_id, paths))
+        if dedup:
+            converted.put((source_id, output))
+        progress.file_done((status, size))
+
+    def job_failed(error):
+        handle_error(error)
+        progress.file_failed(error)
+
+    scheduler = Scheduler(pool, max_in_flight, limits, job_failed, job_done)
+    if adaptive:
+        threading.Thread(target=watch_load,
+                         args=(scheduler, stop_threads, bounds),
+                         daemon=True).start()
+
+    def submit(file, subfolder='', is_svn_repo=False, dedup=dedup):
+        args = (source, dest, orig_ext, debug, set_source_ext,
+                identify_only, keep_originals, q, subfolder,
+                is_svn_repo)
+        file._db = db
+        cls = None
+        mime, puid = file.mime, file.puid
+        if not mime and file._cached:
+            mime, puid = file._cached['mime'], file._cached['puid']
+        elif not mime and file._siegfried:
+            match = get_match(file._siegfried)
+            mime, puid = match['mime'], match['puid']
+        if not identify_only and mime:
+            converter = get_converter(mime, puid, file.ext)
+            cls = concurrency_class(converter, mime)
+        if dedup and file.checksum and file.source_id is None:
+            # Files with the same content and extension are identified
+            # the same, and get the same converter
+            if mime:
+                rule = json.dumps(converter, sort_keys=True, default=str)
+            else:
+                rule = file.ext
+            key = (file.checksum, rule)
+            if key in copies:
+                copies[key].append((file, subfolder, is_svn_repo))
+                return
+            file._reuse = find_output(store, file, mime and converter, dest,
+                                      since)
+            if not file._reuse:
+                copies[key] = []
+                first_ids[file.id] = key
+        file._cls = cls
+        if not scheduler.submit(convert_file, (file,) + args, cls):
+            dropped.append(file)
+
+    def submit_deferred():
+        while not deferred.empty():
+            submit(*deferred.get(), dedup=False)
+
+    def submit_copies(flush=False):
+        """
+        Submit copies of files that are finished, or of all files when
+        `flush`, e.g. if the first file couldn't be converted
+        """
+        while not converted.empty():
+            id, output = converted.get()
+            key = first_ids.pop(id, None)
+            if key is None:
+                continue
+            for args in copies.pop(key):
+                args[0]._reuse = (id, output) if output else None
+                submit(*args, dedup=False)
+        if flush:
+            first_ids.clear()
+            for key in list(copies):
+                for args in copies.pop(key):
+                    submit(*args, dedup=False)
+
+    def submit_members():
+        while not members.empty():
+            source_id, paths = members.get()
+            member_rows = store.add_members(source_id, paths, run_id, lease)
+            progress.add_total(len(member_rows))
+            for member in member_rows:
+                submit(File(member, True))
+
+    conds, params = store.get_conds(finished=True, original=True)
+    i = store.get_row_count(conds, params)
+    subfolder = ''
+    num_files = len(os.listdir(source))
+    last_folder = '.'
+    if run_id:
+        rows = mark_in_progress(store, rows, run_id)
+    files = (File(row, identify_only) for row in rows)
+    if cfg['use_siegfried'] and server_address():
+        start_sf_server()
+    if idcache.enabled() or cfg['dedup']['enabled'] or cfg['use_siegfried']:
+        files = identify_in_batches(files, source,
+                                    cfg['siegfried']['batch'])
+
+    # The first signal stops new conversions and lets those in progress
+    # finish. The second stops those in progress too
+    signals = []
+    # Files that weren't converted because the run was stopped, and
+    # are converted again on the next run
+    dropped = []
+
+    def stop(signum, frame):
+        signals.append(signum)
+        if len(signals) == 1:
+            console.print("\nStopping when conversions in progress are "
+                          "finished. Press Ctrl-C again to stop them now",
+                          style="bold orange1")
+            dropped.extend(args[0] for args in scheduler.cancel())
+
+    handlers = {signum: signal.signal(signum, stop)
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    aborted = False
+    with progress:
+        for file in files:
+            if signals:
+                break
+            submit_members()
+            submit_deferred()
+            submit_copies()
+            if file.source_id in in_progress:
+                # Extracted again from its archive, and registered anew
+                progress.add_total(-1)
+                continue
+            if file.id in in_progress:
+                file._resume_since = run_started.timestamp()
+                if not reconvert:
+                    # Remove rows of any output logged before the interruption
+                    q.put(file.id)
 
             folder = str(file._parent).split(os.sep)[0]
             if folder == '.' or folder != last_folder:
@@ -220,78 +548,276 @@ def convert(
             else:
                 subfolder = ''
 
-            if reconvert and row['source_id'] is None:
+            if reconvert and file.source_id is None:
                 # Remove any copied original files
-                remove_file(Path(dest, row['path']))
+                remove_file(Path(dest, file.path))
 
-                rows = store.get_children(row['id'])
-                for file_row in rows:
+                children = store.get_children(file.id)
+                for file_row in children:
                     remove_file(Path(dest, file_row[1]))
-                q.put(row['id'])
+                q.put(file.id)
+
+            submit(file, subfolder, is_svn_repo)
+
+        # wait for the files still in the pool, and convert the files
+        # they extract. Results are handled before the job is counted
+        # as finished, so no members are left when the pool is idle
+        deadline = None
+        while True:
+            submit_members()
+            submit_deferred()
+            submit_copies()
+            if (
+                scheduler.wait_idle(1) and members.empty()
+                and deferred.empty() and converted.empty()
+            ):
+                if not copies or signals:
+                    break
+                # The first files of these copies failed with an error
+                submit_copies(flush=True)
+            if signals and not deadline:
+                deadline = time.time() + cfg['drain-timeout']
+            if len(signals) > 1 or (deadline and time.time() > deadline):
+                aborted = True
+                break
+    stop_threads.set()
+
+    if signals:
+        # Copies still waiting for the conversion of their first file
+        dropped.extend(args[0] for key in copies for args in copies[key])
+    if aborted:
+        dropped.extend(args[0] for args in scheduler.in_flight_jobs())
+        if threaded:
+            engine.kill_all()
+        else:
+            for worker in pool._pool:
+                kill_children(worker.pid)
+            stopping.set()
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    if threaded:
+        engine.stop()
+    else:
+        atexit.unregister(stopping.set)
 
-            args = (source, dest, orig_ext, debug, set_source_ext,
-                    identify_only, keep_originals, q, count, subfolder,
-                    is_svn_repo)
-            job = pool.apply_async(file.convert, args=args,
-                                   error_callback=handle_error)
-            jobs.append(job)
+    # Let the listener write all results before it stops
+    q.put('kill')
+    writer.join()
+    manager.shutdown()
 
-        # collect results from the workers through the pool result queue
-        for job in jobs:
-            job.get()
+    if signals:
+        store.mark_for_retry([file.id for file in dropped if file.id])
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
 
-        q.put('kill')
+    return 'interrupted' if signals else 'finished'
 
-        pool.close()
-        pool.join()
 
-        duration = str(datetime.timedelta(seconds=round(time.time() - t0)))
-        if identify_only:
-            console.print('\nIdentification finished in ' + duration)
-        else:
-            console.print('\nConversion finished in ' + duration)
-        conds, params = store.get_conds(finished=True, status='accepted',
-                                        timestamp=ts, original=True)
-        count = store.get_row_count(conds, params)
-        if count:
-            console.print(f"{count} files accepted", style="bold green")
-        conds, params = store.get_conds(finished=True, status='converted',
-                                        timestamp=ts, original=True)
-        count = store.get_row_count(conds, params)
-        if count:
-            console.print(f"{count} files converted", style="bold orange1")
-        conds, params = store.get_conds(finished=True, status='skipped',
-                                        timestamp=ts, original=True)
-        count = store.get_row_count(conds, params)
-        if count:
-            console.print(f"{count} files skipped", style="bold orange1")
-        conds, params = store.get_conds(finished=True, status='removed',
-                                        timestamp=ts, original=True)
-        count = store.get_row_count(conds, params)
-        if count:
-            console.print(f"{count} files removed", style="bold orange1")
-
-        conds, params = store.get_conds(finished=True, status='failed',
-                                        timestamp=ts, original=True)
-        count = store.get_row_count(conds, params)
-        if count:
-            console.print(f"{count} files failed", style="bold red")
-
-        console.print(f"See database {db} for details")
+def convert_file(file, *args):
+    """
+    Convert file in a worker, and return its status and size, with
+    paths of the files extracted if it's an archive, and the converted
+    file that copies of the file can reuse
+
+    Files that weren't identified when they were submitted are identified
+    first. If their converter is in a concurrency class with a limit,
+    they're returned as 'deferred' with the file, subfolder and svn flag,
+    so that the main process submits them again in their class, instead
+    of the worker waiting for a free slot
+    """
+    source_dir, dest_dir, identify_only = args[0], args[1], args[5]
+    if not identify_only and file.mime in ['', 'None', None]:
+        file.identify_source(source_dir, dest_dir)
+        converter = get_converter(file.mime, file.puid, file.ext)
+        cls = concurrency_class(converter, file.mime)
+        if cls != file._cls and has_slots(cls):
+            return 'deferred', (file, args[8], args[9])
+
+    file.convert(*args)
+
+    return (file.status, file.size, file._members, file.source_id or file.id,
+            file._output)
+
+
+def identify_in_batches(files, source, batch_size):
+    """
+    Look up batches of unidentified original files in the identification
+    cache, and identify the rest with Siegfried, before they are handed
+    to the workers. With `dedup`, the checksums of the files
+    are also made here, so that copies can be held back
+    """
+    batch = []
+    for file in files:
+        batch.append(file)
+        if len(batch) == batch_size:
+            identify_batch(batch, source)
+            yield from batch
+            batch = []
+    if batch:
+        identify_batch(batch, source)
+        yield from batch
+
+
+def identify_batch(batch, source):
+    if cfg['dedup']['enabled']:
+        set_checksums([file for file in batch if not file.has_checksum()
+                       and file.source_id is None], source)
+    files = [file for file in batch if needs_identify(file)]
+    if idcache.enabled():
+        for file in files:
+            file._cached = idcache.lookup(os.path.join(source, file.path),
+                                          file.get_stat())
+        files = [file for file in files if not file._cached]
+    if cfg['use_siegfried']:
+        identify_files(files, source)
+
+
+def set_checksums(files, source, threads=8):
+    """Set checksum of files, reading several files at a time"""
+    paths = [os.path.join(source, file.path) for file in files]
+    with ThreadPool(threads) as pool:
+        checksums = pool.map(checksum_or_none, paths)
+    for file, digest in zip(files, checksums):
+        file.checksum = digest
+        file.checksum_type = digest and cfg['checksum']['algorithm']
+
+
+def checksum_or_none(path):
+    try:
+        return checksum(path)
+    except OSError:
+        return None
+
+
+def find_output(store, file, converter, dest, since):
+    """
+    Find converted file of a file with the same content, converted since
+    `since` with the same converter as `file`, or with the same extension
+    when `converter` isn't known. Returns its id and path, or None
+    """
+    for row in store.get_outputs(file.checksum, file.checksum_type, since):
+        ext = Path(row['path']).suffix
+        if converter:
+            if get_converter(row['mime'], row['puid'], ext) != converter:
+                continue
+        elif ext != file.ext:
+            continue
+        if row['id'] != file.id and is_converted_file(row['path'],
+                                                      row['output']):
+            return row['id'], os.path.join(dest, row['output'])
+
+    return None
+
+
+def is_converted_file(path, child_path):
+    """
+    Check that child of file is its converted file, and not a file
+    extracted from it, which is in a folder named after the archive
+    """
+    folder = Path(child_path).parent
+    parent = Path(path).parent
+    if not Path(child_path).name.startswith(Path(path).stem):
+        return False
+
+    # The converted file may be in a subfolder made by --distribute
+    return folder == parent or (
+        folder.parts and folder.parts[0].isdigit()
+        and Path(*folder.parts[1:]) == parent
+    )
+
+
+def needs_identify(file):
+    return file.mime in ['', 'None', None] and not file.source_id
+
+
+def mark_in_progress(store, rows, run_id, batch_size=100):
+    """Mark batches of rows with run id before they are converted"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            store.mark_in_progress([row['id'] for row in batch], run_id)
+            yield from batch
+            batch = []
+    if batch:
+        store.mark_in_progress([row['id'] for row in batch], run_id)
+        yield from batch
+
+
+def print_summary(store, db, ts, t0, identify_only=False):
+    """Print duration and number of files with each status"""
+
+    duration = str(datetime.timedelta(seconds=round(time.time() - t0)))
+    if identify_only:
+        console.print('\nIdentification finished in ' + duration)
+    else:
+        console.print('\nConversion finished in ' + duration)
+    conds, params = store.get_conds(finished=True, status='accepted',
+                                    timestamp=ts, original=True)
+    count = store.get_row_count(conds, params)
+    if count:
+        console.print(f"{count} files accepted", style="bold green")
+    conds, params = store.get_conds(finished=True, status='converted',
+                                    timestamp=ts, original=True)
+    count = store.get_row_count(conds, params)
+    if count:
+        console.print(f"{count} files converted", style="bold orange1")
+    conds, params = store.get_conds(finished=True, status='skipped',
+                                    timestamp=ts, original=True)
+    count = store.get_row_count(conds, params)
+    if count:
+        console.print(f"{count} files skipped", style="bold orange1")
+    conds, params = store.get_conds(finished=True, status='removed',
+                                    timestamp=ts, original=True)
+    count = store.get_row_count(conds, params)
+    if count:
+        console.print(f"{count} files removed", style="bold orange1")
+
+    conds, params = store.get_conds(finished=True, status='failed',
+                                    timestamp=ts, original=True)
+    count = store.get_row_count(conds, params)
+    if count:
+        console.print(f"{count} files failed", style="bold red")
+
+    console.print(f"See database {db} for details")
 
 
 def listener(q, db):
     '''listens for messages on the q, writes to database '''
-
-    while 1:
-        file = q.get()
-        if type(file) is int:
-            with Storage(db) as store:
+    ignore_signals()
+    batch_size = cfg['writer']['batch']
+    interval = cfg['writer']['interval'] / 1000
+
+    # Finished files are written together when `batch_size` files are
+    # collected, or `interval` after the first of them
+    files = []
+    flush_at = None
+    with Storage(db) as store:
+        while 1:
+            timeout = max(flush_at - time.time(), 0) if files else None
+            try:
+                file = q.get(timeout=timeout)
+            except queue.Empty:
+                file = None
+            if isinstance(file, File):
+                file.status_ts = datetime.datetime.now()
+                files.append(file)
+                if len(files) == 1:
+                    flush_at = time.time() + interval
+                if len(files) < batch_size:
+                    continue
+
+            # Write files before other messages, so that they're handled
+            # in order
+            if files:
+                store.log_rows([file.__dict__ for file in files])
+                files = []
+            if type(file) is int:
                 store.delete_children(file)
-        elif file == 'kill':
-            break
-        else:
-            file.log(db)
+            elif file == 'kill':
+                break
 
 
 def check_files(source_dir, store):
@@ -4,6 +4,8 @@ import shutil
 import typer
 import petl as etl
 from .storage import Storage
+from .util import copy_with_checksum
+from .config import cfg
 
 app = typer.Typer(rich_markup_mode="markdown")
 cwd = os.getcwd()
@@ -14,6 +16,9 @@ def copy_source_files(source: str, dest: str, db: str, mime: str = None, limit:
     """ Copy original files to destination folder
 
     Makes it possible to make copy of files of certain mime type. 
+    With `checksum: fixity`, the checksum of each file is made while it's
+    copied, and stored if the file hasn't got one. Files that don't match
+    their stored checksum are reported.
     """
 
     if source[0] != '/':
@@ -36,7 +41,17 @@ def copy_source_files(source: str, dest: str, db: str, mime: str = None, limit:
             src_path = Path(source, file['path'])
             dst_path = Path(dest, file['path'])
             os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-            shutil.copyfile(src_path, dst_path)
+            if not cfg['checksum']['fixity']:
+                shutil.copyfile(src_path, dst_path)
+                continue
+            checksum = copy_with_checksum(src_path, dst_path)
+            algorithm = cfg['checksum']['algorithm']
+            if file['checksum'] and file['checksum_type'] == algorithm:
+                if file['checksum'] != checksum:
+                    print(f"\nChecksum of {file['path']} has changed")
+            else:
+                store.update_row({'id': file['id'], 'checksum': checksum,
+                                  'checksum_type': algorithm})
         print(f'\ncopied {i} files')
 
 
@@ -8,7 +8,7 @@ from pathlib import Path
 from natsort import natsorted
 from .storage import Storage
 from .file import File
-from .util import make_filelist, filelist_to_storage
+from .util import scan_to_storage
 
 
 # holds the original path so it can be used in distribute function recursively
@@ -62,8 +62,7 @@ def distribute(
         # Create database if it doesn't exist
         first_run = store.get_row_count() == 0
         if first_run:
-            make_filelist(path)
-            filelist_to_storage(path, store)
+            scan_to_storage(path, store)
 
         dest_path = os.path.join(orig_path, base_path).rstrip('/')
 
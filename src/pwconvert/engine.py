@@ -0,0 +1,132 @@
+from __future__ import annotations
+import os
+import signal
+import locale
+import asyncio
+import threading
+
+from .config import cfg
+
+# Engine that runs shell commands of this process, set while the
+# conversions run in threads with `engine: async`
+_engine = None
+
+
+def get_engine() -> CommandEngine | None:
+    return _engine
+
+
+def set_engine(engine: CommandEngine | None) -> None:
+    global _engine
+    _engine = engine
+
+
+async def async_run_shell_cmd(command, cwd=None, timeout=None,
+                              shell=False, procs=None) -> tuple[int, str, str]:
+    """
+    Run the given command as an asyncio subprocess
+
+    Works like `run_shell_cmd`, with the command in a process group of its
+    own that is killed on timeout, and text output. The process is held
+    in the set `procs` while it runs
+    """
+    os.environ["PYTHONUNBUFFERED"] = "1"
+
+    # Make calls from subprocess timeout before main subprocess
+    if not timeout:
+        timeout = cfg['timeout'] - 1
+
+    try:
+        if shell:
+            proc = await asyncio.create_subprocess_shell(
+                command, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, env=os.environ,
+                start_new_session=True
+            )
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                *command, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, env=os.environ,
+                start_new_session=True
+            )
+    except Exception as e:
+        return 1, '', e
+
+    if procs is not None:
+        procs.add(proc)
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            kill_process_group(proc.pid, signal.SIGKILL)
+            await proc.wait()
+        return 1, 'timeout', None
+    finally:
+        if procs is not None:
+            procs.discard(proc)
+
+    try:
+        return proc.returncode, decode(out), decode(err)
+    except Exception as e:
+        return 1, '', e
+
+
+def kill_process_group(pid, sig):
+    try:
+        os.killpg(os.getpgid(pid), sig)
+    except ProcessLookupError:
+        pass
+
+
+def decode(data: bytes) -> str:
+    """Decode output the same way as `universal_newlines`"""
+    text = data.decode(locale.getpreferredencoding(False))
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+class CommandEngine:
+    """
+    Runs shell commands from many threads in one asyncio event loop
+
+    The loop runs in a thread of its own, and the calling thread waits
+    for the command to finish, so that conversions running in threads
+    don't need a process each to wait for their commands
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        # Processes running, only used from the event loop
+        self._procs = set()
+
+    def start(self):
+        """Start event loop, and run the shell commands of this process"""
+        self._thread.start()
+        set_engine(self)
+
+    def stop(self):
+        set_engine(None)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def run(self, command, cwd=None, timeout=None,
+            shell=False) -> tuple[int, str, str]:
+        """Run command in the event loop, and wait for it to finish"""
+        future = asyncio.run_coroutine_threadsafe(
+            async_run_shell_cmd(command, cwd, timeout, shell, self._procs),
+            self._loop
+        )
+        return future.result()
+
+    def kill_all(self):
+        """Kill the process groups of all running commands"""
+        async def kill():
+            for proc in self._procs:
+                kill_process_group(proc.pid, signal.SIGKILL)
+
+        asyncio.run_coroutine_threadsafe(kill(), self._loop).result()
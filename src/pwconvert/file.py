@@ -1,8 +1,7 @@
 from __future__ import annotations
 import os
+import codecs
 import shutil
-import json
-import subprocess
 from os.path import relpath
 from inspect import currentframe, getframeinfo
 from pathlib import Path
@@ -11,17 +10,38 @@ from shlex import quote
 import time
 import mimetypes
 import datetime
+import threading
 from rich.console import Console
 
-import magic
-
 from .storage import Storage
 from .config import cfg, converters
-from .util import run_shell_cmd
+from .util import (run_shell_cmd, set_uno_port, uno_server_responding,
+                   restart_uno_instance, delete_file_or_dir, link_file,
+                   checksum, copy_with_checksum)
+from .scheduler import converter_slot, converter_tool, get_timeout
+from . import siegfried
+from .sniff import sniff, read_header
+from . import idcache
 
 console = Console()
 cwd = os.getcwd()
 
+# Connection to the database of each worker, kept open between files
+_local = threading.local()
+
+
+def get_store(db):
+    """Get storage of db for this worker, opened on first use"""
+    store = getattr(_local, 'store', None)
+    if store is None or store.path != db:
+        if store:
+            store.close_data_source()
+        store = Storage(db)
+        store.load_data_source()
+        _local.store = store
+
+    return store
+
 
 class File:
     """Contains methods for converting files"""
@@ -39,68 +59,165 @@ class File:
         self.format = None if unidentify else row['format']
         self.version = None if unidentify else row['version']
         self.size = row['size']
+        # Modification time and inode from the scan of the source folder
+        self.mtime = row.get('mtime')
+        self.inode = row.get('inode')
         self.puid = None if unidentify else row['puid']
         self.source_id = row['source_id']
         self._parent = Path(self.path).parent
         self._stem = Path(self.path).stem
         self.ext = Path(self.path).suffix
         self.kept = None if unidentify else row['kept']
-        self._content = None
-
-    def set_progress(self, progress):
-        self._progress = progress
+        self.duration = row.get('duration')
+        self.tool = row.get('tool')
+        self.checksum = row.get('checksum')
+        self.checksum_type = row.get('checksum_type')
+        # Id of file with the same content, whose converted file was reused
+        self.reused_from = row.get('reused_from')
+        # Concurrency class the file was submitted in
+        self._cls = None
+        # Database the worker writes text content of the file to
+        self._db = None
+        # Id and converted file of a file with the same content, to be
+        # reused instead of converting the file again
+        self._reuse = None
+        # Converted file, which files with the same content can reuse
+        self._output = None
+        # Cached identification, when looked up together with other files
+        self._cached = None
+        # Siegfried result, when identified together with other files
+        self._siegfried = None
+        # Start of the file, read once for all steps of the identification
+        self._header = None
+        # Paths of files extracted from the file, if it's an archive
+        self._members = []
+        # Start time of an interrupted run the file was in progress in
+        self._resume_since = None
 
     def set_metadata(self, source_path, source_dir):
+        # Use identification cached from earlier runs if there is one
+        cached = self._cached
+        self._cached = None
+        stat = self.get_stat()
+        if cached is None and idcache.enabled():
+            cached = idcache.lookup(source_path, stat)
+
+        if cached:
+            for key, value in cached.items():
+                setattr(self, key, value)
+            if self.size is None:
+                self.size = os.path.getsize(source_path)
+        else:
+            self.identify(source_path)
+            # Don't cache the fallback if Siegfried couldn't be run
+            if idcache.enabled() and (self.puid or not cfg['use_siegfried']):
+                idcache.add(source_path, {field: getattr(self, field)
+                                          for field in idcache.FIELDS}, stat)
+
+        if (
+            self.encoding and self.encoding != 'binary' and cfg['get-text']
+            and self._db
+        ):
+            # Text of converted files is put on the original file
+            try:
+                get_store(self._db).replace_content(
+                    self.id or self.source_id, self.iter_text(source_path)
+                )
+            except Exception as e:
+                print('self.path', self.path)
+                print('self.encoding', self.encoding)
+                print(e)
+
+        self._header = None
+
+    def get_stat(self):
+        """
+        Get size, modification time and inode of the file from the scan of
+        the source folder, or None if the file wasn't found by the scan
+        """
+        if None in (self.size, self.mtime, self.inode):
+            return None
+
+        return self.size, self.mtime, self.inode
+
+    def get_header(self, source_path):
+        """Get start of file, reading it the first time"""
+        if self._header is None:
+            self._header = read_header(source_path)
+
+        return self._header
+
+    def iter_text(self, source_path, chunk_size=1024 * 1024):
+        """
+        Get text of file in chunks, with whitespace collapsed to single
+        spaces, up to `max-text-size` characters
+
+        The file is read and decoded a chunk at a time, starting with the
+        header, so that only the text kept is held in memory, not the
+        whole file
+        """
+        limit = cfg['max-text-size']
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        header = self.get_header(source_path)
+        size = 0
+        # Word split by the end of the chunk, put before the next chunk
+        rest = ''
+        with open(source_path, 'rb') as f:
+            f.seek(len(header))
+            data = header
+            while data:
+                next_data = f.read(chunk_size)
+                text = rest + decoder.decode(data, final=not next_data)
+                words = text.split()
+                rest = words.pop() if words and not text[-1].isspace() else ''
+                if words:
+                    chunk = (' ' if size else '') + ' '.join(words)
+                    if limit and size + len(chunk) >= limit:
+                        yield chunk[:limit - size]
+                        return
+                    size += len(chunk)
+                    yield chunk
+                elif limit and len(rest) >= limit - size:
+                    break
+                data = next_data
+
+        if rest:
+            chunk = (' ' if size else '') + rest
+            yield chunk[:limit - size] if limit else chunk
+
+    def identify(self, source_path):
+        """Identify file with Siegfried, or libmagic if Siegfried fails"""
         if cfg['use_siegfried']:
-            cmd = ['sf', '-json', source_path]
-            p = subprocess.Popen(cmd, cwd=source_dir, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            # Use result from identification of many files at once
+            # if there is one
+            fileinfo = self._siegfried or siegfried.identify(source_path)
+            self._siegfried = None
 
             self.encoding = None
-            if not err:
-                fileinfo = json.loads(out)
-                self.mime = fileinfo['files'][0]['matches'][0]['mime']
-                self.format = fileinfo['files'][0]['matches'][0]['format']
-                self.version = fileinfo['files'][0]['matches'][0]['version']
-                self.size = fileinfo['files'][0]['filesize']
-                self.puid = fileinfo['files'][0]['matches'][0]['id']
+            if fileinfo:
+                for key, value in siegfried.get_match(fileinfo).items():
+                    setattr(self, key, value)
 
+        sniffed = None
         if self.mime in ['', 'None', None]:
-            cmd = ['file', '-i', '-b', source_path]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            fileinfo = result.stdout
-            self.mime = fileinfo.split(';')[0]
+            sniffed = sniff(source_path, self.get_header(source_path))
+            self.mime, self.encoding, self.format = sniffed
             # file command uses wrong mimetype in older versions
             if self.mime == 'application/csv':
                 self.mime = 'text/csv'
-            self.encoding = fileinfo.split(';')[1].replace('charset=', '').strip()
-            self.format = magic.from_file(source_path).split(',')[0]
-            self.size = os.path.getsize(source_path)
+            if self.size is None:
+                self.size = os.path.getsize(source_path)
 
         if not self.encoding and (
             self.mime.startswith('text/') or self.mime == 'application/json'
         ):
-            cmd = ['file', '-i', '-b', source_path]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            self.encoding = result.stdout.split(';')[1].replace('charset=', '').strip()
+            self.encoding = (
+                sniffed or sniff(source_path, self.get_header(source_path))
+            )[1]
 
         if self.encoding in ['ascii', 'us-ascii']:
             self.encoding = 'utf-8'
 
-        if self.encoding and self.encoding != 'binary' and cfg['get-text']:
-            with open(source_path, 'r', encoding=self.encoding) as file:
-                content = None
-                try:
-                    content = file.read()
-                except Exception as e:
-                    print('self.path', self.path)
-                    print('self.encoding', self.encoding)
-                    print(e)
-
-                if content:
-                    self._content = ' '.join(content.split())
-
     def get_dest_ext(self, converter, dest_path, orig_ext, accept):
         dest_ext = None
         # keep extension for text files converted to utf8
@@ -134,7 +251,10 @@ class File:
                               quote(str(Path(source_path).parent) + '/'))
             cmd = cmd.replace("<dest-parent>",
                               quote(str(Path(dest_path).parent) + '/'))
-            cmd = cmd.replace("<pid>", str(os.getpid()))
+            # The id of the thread is the process id in worker processes,
+            # and differs between conversions running at the same time
+            # in threads of the async engine
+            cmd = cmd.replace("<pid>", str(threading.get_native_id()))
             cmd = cmd.replace("<stem>", quote(self._stem))
             cmd = cmd.replace("<accept>", str(accept).lower())
             if self.encoding:
@@ -142,6 +262,81 @@ class File:
 
         return cmd
 
+    def restore_from_temp(self, source_path, temp_path):
+        """
+        Move back original file moved to temp folder before conversion
+        in the interrupted run
+
+        The original keeps its modification time when moved, while
+        output written by the interrupted run is newer than the run
+        """
+        if (
+            os.path.isfile(temp_path)
+            and os.path.getmtime(temp_path) < self._resume_since
+            and (not os.path.exists(source_path)
+                 or os.path.getmtime(source_path) >= self._resume_since)
+        ):
+            shutil.move(temp_path, source_path)
+
+    def run_conversion_cmd(self, cmd, converter, dest_path, timeout):
+        """
+        Run conversion command in a free slot of the converter
+
+        If the command fails because the unoserver instance it used
+        stopped responding, the instance is restarted and the command
+        run again
+        """
+        retries = cfg['unoserver']['retries']
+        while True:
+            with converter_slot(converter, self.mime) as port:
+                run_cmd = set_uno_port(cmd, port) if port else cmd
+                returncode, out, err = run_shell_cmd(run_cmd, cwd=cwd, shell=True,
+                                                     timeout=timeout)
+                if not returncode or not port or uno_server_responding(port):
+                    return returncode, out, err
+
+                restart_uno_instance(port)
+
+            if retries == 0:
+                return returncode, out, err
+            retries -= 1
+            if os.path.isfile(dest_path):
+                os.remove(dest_path)
+
+    def has_checksum(self):
+        """Check if file has a checksum made with the configured algorithm"""
+        return (self.checksum is not None
+                and self.checksum_type == cfg['checksum']['algorithm'])
+
+    def set_checksum(self, path):
+        self.checksum = checksum(path)
+        self.checksum_type = cfg['checksum']['algorithm']
+
+    def copy_original(self, source_path, copy_path):
+        """
+        Copy original file to destination folder, and make its checksum
+        in the same pass when `checksum: fixity` is set
+        """
+        if not cfg['checksum']['fixity']:
+            shutil.copyfile(source_path, copy_path)
+            return
+
+        self.checksum = copy_with_checksum(source_path, copy_path)
+        self.checksum_type = cfg['checksum']['algorithm']
+
+    def reuse_output(self, dest_path):
+        """
+        Link converted file of a file with the same content to
+        `dest_path`, instead of converting the file. Returns False if
+        there's no converted file to reuse
+        """
+        if not self._reuse or not os.path.isfile(self._reuse[1]):
+            return False
+        link_file(self._reuse[1], dest_path, cfg['dedup']['link'])
+        self.reused_from = self._reuse[0]
+
+        return True
+
     def is_accepted(self, converter):
         accept = False
         if 'accept' in converter:
@@ -154,10 +349,30 @@ class File:
 
         return accept
 
+    def identify_source(self, source_dir, dest_dir):
+        """
+        Get path of file to convert, and identify it if it isn't identified
+
+        Files extracted from archives are in `dest_dir`
+        """
+        if self.source_id and os.path.isfile(os.path.join(dest_dir, self.path)):
+            source_path = os.path.join(dest_dir, self.path)
+        else:
+            source_path = os.path.join(source_dir, self.path)
+
+        temp_path = os.path.join('/tmp/convert',  self.path)
+        if self._resume_since:
+            self.restore_from_temp(source_path, temp_path)
+
+        if self.mime in ['', 'None', None]:
+            self.set_metadata(source_path, source_dir)
+
+        return source_path
+
     def convert(
         self, source_dir: str, dest_dir: str, orig_ext: bool, debug: bool,
         set_source_ext: bool, identify_only: bool, keep_originals: bool,
-        q=None, count=None, subfolder='', is_svn_repo=False
+        q=None, subfolder='', is_svn_repo=False
     ) -> dict[str, Type[str]]:
         """
         Convert file to archive format
@@ -168,22 +383,14 @@ class File:
         - None if file isn't converted
         """
 
-        if hasattr(self, '_progress'):
-            count['finished'].value += 1
-            self._count = count
-            print(end='\x1b[2K')  # clear line
-            print(f"\r{self._progress} | "
-                  f"{self.path[0:60]}", end=" ", flush=True)
+        source_path = self.identify_source(source_dir, dest_dir)
+        temp_path = os.path.join('/tmp/convert',  self.path)
 
-        if self.source_id and os.path.isfile(os.path.join(dest_dir, self.path)):
-            source_path = os.path.join(dest_dir, self.path)
+        # Use the modification time from the scan of the source folder
+        if self.source_id is None and self.mtime is not None:
+            self._mtime = self.mtime
         else:
-            source_path = os.path.join(source_dir, self.path)
-
-        if self.mime in ['', 'None', None]:
-            self.set_metadata(source_path, source_dir)
-
-        self._mtime = os.path.getmtime(source_path)
+            self._mtime = os.path.getmtime(source_path)
 
         # Make extension part of stem if it's not a known extension
         # This catches files without extension but with dot in file name
@@ -200,7 +407,7 @@ class File:
             self._stem = self._stem + self.ext
             self.ext = None
 
-        converter = converters[self.mime] if self.mime in converters else {}
+        converter = dict(converters[self.mime]) if self.mime in converters else {}
         if 'keep' in converter and converter['keep'] is True:
             self.kept = True
         else:
@@ -240,7 +447,6 @@ class File:
             self.kept = True
 
         dest_path = os.path.join(dest_dir, subfolder, self._parent, self._stem)
-        temp_path = os.path.join('/tmp/convert',  self.path)
         dest_path = os.path.abspath(dest_path)
         os.makedirs(os.path.dirname(dest_path), exist_ok=True)
         norm_path = None
@@ -251,13 +457,20 @@ class File:
             if dest_ext:
                 dest_path = dest_path + dest_ext
 
+            # Remove output written by the interrupted run, so that it's
+            # not mistaken for a manual conversion
+            if (
+                self._resume_since and os.path.exists(dest_path)
+                and os.path.getmtime(dest_path) >= self._resume_since
+            ):
+                delete_file_or_dir(dest_path)
+
             if (
                 is_svn_repo and cfg['svn-rename'] and source_path != dest_path
                 and not self.kept
             ):
-                os.chdir(source_dir)
                 cmd = ['svn', 'move', source_path, dest_path]
-                result, out, err = run_shell_cmd(cmd)
+                result, out, err = run_shell_cmd(cmd, cwd=source_dir)
                 if result == 0:
                     orig_path = source_path
                     source_path = dest_path
@@ -276,15 +489,27 @@ class File:
             # Disabled because not in use, and file command doesn't have version
             # with option --mime-type
             # cmd = cmd.replace("<version>", '"' + self.version + '"')
-            timeout = (converter['timeout'] if 'timeout' in converter
-                       else cfg['timeout'])
+            # Learned from earlier conversions of files like this one
+            timeout = get_timeout(converter, self.mime, self.puid, self.size)
+            if not timeout:
+                timeout = (converter['timeout'] if 'timeout' in converter
+                           else cfg['timeout'])
 
             returncode = 0
-            # Don't run convert command if file is converted manually
-            if (not os.path.isfile(dest_path) or os.path.getsize(dest_path) == self.size):
+            self.reused_from = None
+            # Don't run convert command if file is converted manually,
+            # or if the converted file of a copy can be reused
+            if (
+                (not os.path.isfile(dest_path) or os.path.getsize(dest_path) == self.size)
+                and not self.reuse_output(dest_path)
+            ):
 
-                returncode, out, err = run_shell_cmd(cmd, cwd=cwd,
-                                                     shell=True, timeout=timeout)
+                self.tool = converter_tool(converter)
+                t0 = time.time()
+                returncode, out, err = self.run_conversion_cmd(
+                    cmd, converter, dest_path, timeout
+                )
+                self.duration = round(time.time() - t0, 3)
 
             if returncode or not os.path.exists(dest_path):
                 if os.path.isfile(dest_path):
@@ -318,7 +543,7 @@ class File:
 
                 if orig_path:
                     cmd = ['svn', 'move', dest_path, orig_path]
-                    result, out, err = run_shell_cmd(cmd)
+                    result, out, err = run_shell_cmd(cmd, cwd=source_dir)
 
                 norm_path = False
                 self.kept = True
@@ -368,7 +593,7 @@ class File:
                 norm_path = relpath(copy_path, start=dest_dir)
             if (self.source_id is None and source_dir != dest_dir) or self.status == 'renamed':
                 try:
-                    shutil.copyfile(source_path, copy_path)
+                    self.copy_original(source_path, copy_path)
                 except Exception as e:
                     frame = getframeinfo(currentframe())
                     filename = frame.filename
@@ -393,19 +618,9 @@ class File:
                          for (dirpath, dirnames, filenames)
                          in os.walk(dest_path) for f in filenames]
                 q.put(self)
-                for file_path in files:
-                    row = {
-                        'id': None,
-                        'path': file_path,
-                        'encoding': None,
-                        'status': 'new',
-                        'size': None,
-                        'source_id': self.source_id or self.id,
-                        'kept': False
-                    }
-                    file = File(row, True)
-                    file.convert(source_dir, dest_dir, orig_ext, debug,
-                                 set_source_ext, identify_only, keep_originals, q)
+                # The files are registered and converted as jobs of
+                # their own by the main process
+                self._members = files
 
                 return
 
@@ -419,6 +634,7 @@ class File:
                 'kept': False
             }
             new_file = File(row, True)
+            new_file._db = self._db
             new_file.set_metadata(str(dest_path), dest_dir)
             # Fix wrong mime type, e.g plain text recognized as html
             if new_file.ext:
@@ -429,6 +645,14 @@ class File:
                 new_file.ext = mimetypes.guess_extension(mime)
                 new_file.path = new_file.path + new_file.ext
                 shutil.move(Path(dest_dir, norm_path), Path(dest_dir, new_file.path))
+            self._output = str(Path(dest_dir, new_file.path))
+            if cfg['checksum']['fixity']:
+                if self.status == 'renamed' and self.has_checksum():
+                    # The file is a copy of the original
+                    new_file.checksum = self.checksum
+                    new_file.checksum_type = self.checksum_type
+                else:
+                    new_file.set_checksum(self._output)
 
             q.put(self)
             # If the file is converted again with the same extension,
@@ -446,6 +670,7 @@ class File:
                 new_file.convert(source_dir, dest_dir, orig_ext,
                                  debug, set_source_ext, identify_only,
                                  keep_originals, q)
+                self._members = new_file._members
         else:
             q.put(self)
 
@@ -454,10 +679,6 @@ class File:
             self.status_ts = datetime.datetime.now()
             if self.id:
                 store.update_row(self.__dict__)
-                if self._content:
-                    store.write_content(self.id, self._content)
             else:
                 store.add_row(self.__dict__)
-                if self._content:
-                    store.write_content(self.source_id, self._content)
 
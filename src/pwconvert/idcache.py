@@ -0,0 +1,172 @@
+import os
+import time
+import functools
+import sqlite3
+import threading
+
+from .config import cfg
+from .util import checksum
+from . import siegfried, sniff
+
+# Connections to the cache database, one for each worker
+_local = threading.local()
+
+FIELDS = ['puid', 'mime', 'format', 'version', 'encoding']
+
+_create_identification = """
+CREATE TABLE IF NOT EXISTS identification(
+    key varchar(100) primary key,
+    puid varchar(100),
+    mime varchar(100),
+    format varchar(150),
+    version varchar(50),
+    encoding varchar(30),
+    used float
+);
+"""
+
+# Versions of the tools the cached files were identified with
+_create_tool = """
+CREATE TABLE IF NOT EXISTS tool(
+    name varchar(20) primary key,
+    version varchar(1000)
+);
+"""
+
+
+def enabled():
+    return bool(cfg['identify-cache']['path'])
+
+
+def get_conn():
+    """Get connection to the cache database, shared by all databases"""
+    if getattr(_local, 'conn', None) is None:
+        path = os.path.expanduser(cfg['identify-cache']['path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA journal_mode=wal')
+        conn.execute(_create_identification)
+        conn.execute('CREATE INDEX IF NOT EXISTS identification_used '
+                     'ON identification(used)')
+        conn.execute(_create_tool)
+        check_versions(conn)
+        _local.conn = conn
+        _local.added = 0
+
+    return _local.conn
+
+
+@functools.lru_cache(maxsize=1)
+def tool_versions():
+    """
+    Get versions of libmagic, and of Siegfried with its signature file
+    when it's used
+    """
+    versions = {'libmagic': sniff.version()}
+    if cfg['use_siegfried']:
+        versions['siegfried'] = siegfried.version()
+
+    return versions
+
+
+def check_versions(conn):
+    """
+    Clear the cache when files in it were identified with other versions
+    of the tools, as the identifications may have changed
+    """
+    cached = dict(conn.execute("SELECT name, version FROM tool").fetchall())
+    versions = tool_versions()
+    if all(cached.get(name) == version for name, version in versions.items()):
+        return
+    conn.execute("DELETE FROM identification")
+    conn.executemany("REPLACE INTO tool (name, version) VALUES (?, ?)",
+                     versions.items())
+    conn.commit()
+
+
+@functools.lru_cache(maxsize=4096)
+def folder_device(folder):
+    """Get device of folder, which is also the device of its files"""
+    return os.stat(folder).st_dev
+
+
+def fingerprint(path, stat=None):
+    """
+    Get cache key of file
+
+    With `key: content` it's a digest of the content, which finds files
+    copied to other storage. Otherwise it's made from device, inode, size
+    and modification time, which doesn't need the file to be read. These
+    are taken from `stat`, with size, modification time and inode from
+    the scan of the source folder, when it's given
+    """
+    if cfg['identify-cache']['key'] == 'content':
+        return 'sha256:' + checksum(path, 'sha256')
+
+    if stat:
+        size, mtime, inode = stat
+        device = folder_device(os.path.dirname(path))
+    else:
+        st = os.stat(path)
+        size, mtime, inode, device = (st.st_size, st.st_mtime, st.st_ino,
+                                      st.st_dev)
+
+    return f"stat:{device}:{inode}:{size}:{mtime}"
+
+
+def lookup(path, stat=None):
+    """Get cached identification of file, or None if it's not cached"""
+    try:
+        key = fingerprint(path, stat)
+        conn = get_conn()
+        row = conn.execute(
+            f"SELECT {', '.join(FIELDS)}, used FROM identification "
+            "WHERE key = ?", (key,)
+        ).fetchone()
+        # Identified without Siegfried, when it wasn't used
+        if row is None or (cfg['use_siegfried'] and not row[0]):
+            return None
+        # Only write when the last use is old enough to matter for eviction
+        if time.time() - row[-1] > 3600:
+            conn.execute("UPDATE identification SET used = ? WHERE key = ?",
+                         (time.time(), key))
+            conn.commit()
+    except (OSError, sqlite3.Error):
+        return None
+
+    return dict(zip(FIELDS, row[:-1]))
+
+
+def add(path, values, stat=None):
+    """Cache identification of file, evicting least recently used entries"""
+    try:
+        key = fingerprint(path, stat)
+        conn = get_conn()
+        conn.execute(
+            f"REPLACE INTO identification (key, {', '.join(FIELDS)}, used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [key] + [values.get(field) for field in FIELDS] + [time.time()]
+        )
+        conn.commit()
+        _local.added += 1
+        # Only count the entries now and then
+        if _local.added % 1000 == 0:
+            evict(conn)
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def evict(conn):
+    """Delete least recently used entries above `max-entries`"""
+    max_entries = cfg['identify-cache']['max-entries']
+    count = conn.execute("SELECT count(*) FROM identification").fetchone()[0]
+    if count <= max_entries:
+        return
+    # Make room for some more entries, so that this isn't done too often
+    excess = count - int(max_entries * 0.9)
+    conn.execute("""
+        DELETE FROM identification WHERE key IN (
+            SELECT key FROM identification ORDER BY used LIMIT ?
+        )
+    """, (excess,))
+    conn.commit()
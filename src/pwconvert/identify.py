@@ -0,0 +1,209 @@
+import os
+import time
+import queue
+import datetime
+from multiprocessing import Pool
+import typer
+from rich.console import Console
+
+from .storage import Storage
+from .file import File
+from .progress import ConversionProgress
+from .scheduler import Scheduler
+from .siegfried import start_sf_server, identify_files
+from .convert import ignore_sigint, limit_cpu
+from .util import scan_to_storage
+from . import idcache
+from .config import cfg
+
+app = typer.Typer(rich_markup_mode="rich")
+console = Console()
+cwd = os.getcwd()
+
+
+def init_worker():
+    "is called at every process start"
+    ignore_sigint()
+    limit_cpu()
+
+
+@app.command()
+def identify(
+    source: str,
+    dest: str = typer.Option(default=None, help="Path to destination folder"),
+    db: str = typer.Option(default=None, help="Name of MySQL base"),
+    mime: str = typer.Option(default=None, help="Filter on mime-type"),
+    puid: str = typer.Option(default=None,
+                             help="Filter on PRONOM Unique Identifier"),
+    ext: str = typer.Option(default=None, help="Filter on file extension"),
+    status: str = typer.Option(
+        default=None,
+        help="Filter on conversion status"
+    ),
+    reidentify: bool = typer.Option(
+        default=False,
+        help="Identify files again, also those already identified"
+    ),
+    batch: int = typer.Option(
+        default=cfg['identify']['batch'],
+        help="Number of files identified at a time by each worker"
+    ),
+    workers: int = typer.Option(
+        default=cfg['identify']['workers'],
+        help="Number of worker processes. Defaults to the number of CPUs"
+    )
+) -> None:
+    """
+    Identify files in SOURCE folder, without converting them
+
+    Rows in the database without mime type are identified in batches by
+    the workers, and the results written to the database a batch at a
+    time. `pw convert` then only converts the identified files.
+    """
+
+    if source[0] != '/':
+        source = os.path.join(cwd, source)
+    if dest and dest[0] != '/':
+        dest = os.path.join(cwd, dest)
+    dest = dest or source
+
+    if not db:
+        db = dest.rstrip('/') + '.db'
+
+    with Storage(db) as store:
+        if store.get_row_count() == 0:
+            scan_to_storage(source, store)
+
+        conds, params = [], []
+        for col, value in [('mime', mime), ('puid', puid),
+                           ('status', status), ('ext', ext)]:
+            if value is not None:
+                conds.append(f"{col} = ?")
+                params.append(value)
+        if not reidentify:
+            conds.append('mime is null')
+
+        count = store.get_row_count(conds, params)
+        console.print(f"Identifying {count} files..", style="bold cyan")
+
+        if cfg['use_siegfried']:
+            start_sf_server()
+
+        t0 = time.time()
+        identified = identify_rows(store, store.iter_rows(conds, params),
+                                   count, db, source, dest, batch, workers)
+
+    duration = str(datetime.timedelta(seconds=round(time.time() - t0)))
+    console.print(f"\nIdentification finished in {duration}")
+    console.print(f"{identified} files identified", style="bold green")
+    if identified < count:
+        console.print(f"{count - identified} files couldn't be identified",
+                      style="bold red")
+    console.print(f"See database {db} for details")
+
+
+def identify_rows(store, rows, total_count, db, source, dest, batch_size=200,
+                  workers=None):
+    """
+    Identify rows with a pool of workers, a batch of rows for each job,
+    and write the results to db with one statement for each batch
+
+    Returns the number of files identified
+    """
+    # Batches identified by the workers, written from this thread
+    results = queue.Queue()
+    pool = Pool(workers, init_worker)
+    # Keep all workers busy, without reading all rows into memory
+    scheduler = Scheduler(pool, 2 * (workers or os.cpu_count()), {},
+                          callback=results.put, error_callback=print)
+    identified = 0
+
+    with ConversionProgress(total_count, "Identifying") as progress:
+
+        def write_results():
+            nonlocal identified
+            while True:
+                try:
+                    batch = results.get_nowait()
+                except queue.Empty:
+                    return
+                found = [row for row in batch if row['mime']]
+                store.update_identification(found)
+                identified += len(found)
+                for row in batch:
+                    if row['mime']:
+                        progress.file_done(('identified', row['size']))
+                    else:
+                        progress.file_failed(None)
+
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == batch_size:
+                    scheduler.submit(identify_batch, (batch, source, dest, db))
+                    batch = []
+                    write_results()
+            if batch:
+                scheduler.submit(identify_batch, (batch, source, dest, db))
+            while not scheduler.wait_idle(1):
+                write_results()
+        except KeyboardInterrupt:
+            # Files not written yet are identified on the next run
+            scheduler.cancel()
+            pool.terminate()
+            console.print("Identification stopped", style="bold red")
+        else:
+            pool.close()
+        pool.join()
+        write_results()
+
+    return identified
+
+
+def identify_batch(rows, source, dest, db):
+    """
+    Identify a batch of files, and return their identification
+
+    Files with mime type None couldn't be identified. The batch is looked
+    up in the identification cache, and the rest identified at once with
+    Siegfried. Text content is written to db by the worker
+    """
+    files = [File(row, True) for row in rows]
+    for file in files:
+        file._db = db
+    # Files extracted from archives are in the destination folder
+    folders = {file.id: dest if file.source_id and os.path.isfile(
+                   os.path.join(dest, file.path)) else source
+               for file in files}
+
+    if idcache.enabled():
+        for file in files:
+            path = os.path.join(folders[file.id], file.path)
+            file._cached = idcache.lookup(path, file.get_stat())
+    if cfg['use_siegfried']:
+        for folder in set(folders.values()):
+            identify_files([file for file in files if not file._cached
+                            and folders[file.id] == folder], folder)
+
+    result = []
+    for file in files:
+        folder = folders[file.id]
+        try:
+            if (
+                cfg['dedup']['enabled'] and file.source_id is None
+                and not file.has_checksum()
+            ):
+                file.set_checksum(os.path.join(folder, file.path))
+            file.set_metadata(os.path.join(folder, file.path), folder)
+        except Exception as e:
+            print(f"Couldn't identify {file.path}: {e}", flush=True)
+            file.mime = None
+        result.append({
+            'id': file.id, 'puid': file.puid, 'mime': file.mime,
+            'format': file.format, 'version': file.version,
+            'encoding': file.encoding, 'size': file.size,
+            'checksum': file.checksum, 'checksum_type': file.checksum_type
+        })
+
+    return result
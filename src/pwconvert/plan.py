@@ -0,0 +1,308 @@
+import os
+import random
+import datetime
+from collections import defaultdict
+from multiprocessing import Pool
+import typer
+from rich.console import Console
+from rich.table import Table
+
+from .storage import Storage
+from .file import File
+from .scheduler import get_converter, concurrency_class, get_limits
+from .util import human_size
+from .siegfried import start_sf_server
+from .config import cfg
+
+app = typer.Typer(rich_markup_mode="rich")
+console = Console()
+cwd = os.getcwd()
+
+
+@app.command()
+def plan(
+    source: str,
+    dest: str = typer.Option(default=None, help="Path to destination folder"),
+    db: str = typer.Option(default=None, help="Name of MySQL base"),
+    mime: str = typer.Option(default=None, help="Filter on mime-type"),
+    puid: str = typer.Option(default=None,
+                             help="Filter on PRONOM Unique Identifier"),
+    ext: str = typer.Option(default=None, help="Filter on file extension"),
+    status: str = typer.Option(
+        default=None,
+        help="Filter on conversion status"
+    ),
+    reconvert: bool = typer.Option(default=False, help="Reconvert files"),
+    retry: bool = typer.Option(
+        default=False,
+        help="Try to convert files where conversion previously failed"
+    ),
+    sample: int = typer.Option(
+        default=1000,
+        help="Number of unidentified files to identify for the estimate"
+    )
+) -> None:
+    """
+    Estimate the conversion of files in SOURCE folder
+
+    Shows expected number of accepted, converted and skipped files, run
+    time, CPU hours and size of the converted files. Files already
+    identified in the database are all counted. For unidentified files,
+    a random sample is identified, and the result scaled up.
+
+    Run time and output size are estimated from conversions in the
+    database, and are only shown for mime types converted before.
+    No files are added or updated in the database, but as with the other
+    commands, the schema of a database made by an older version is
+    upgraded when it's opened.
+    """
+
+    if source[0] != '/':
+        source = os.path.join(cwd, source)
+    if dest and dest[0] != '/':
+        dest = os.path.join(cwd, dest)
+    dest = dest or source
+
+    if not db:
+        db = dest.rstrip('/') + '.db'
+
+    if cfg['use_siegfried']:
+        start_sf_server()
+
+    # Don't make an empty SQLite database for the plan
+    if '.' in db and not os.path.isfile(db):
+        groups = survey_folder(source, sample)
+        history, outcomes, output_sizes = {}, {}, {}
+    else:
+        with Storage(db) as store:
+            conds, params = store.get_conds(mime=mime, puid=puid,
+                                            status=status, reconvert=reconvert,
+                                            ext=ext, retry=retry)
+            if store.get_row_count() == 0:
+                groups = survey_folder(source, sample)
+            else:
+                groups = survey_storage(store, conds, params, source, sample)
+            history = store.get_durations()
+            outcomes = store.get_outcomes()
+            output_sizes = store.get_output_sizes()
+
+    estimate = make_estimate(groups, history, outcomes, output_sizes,
+                             copy=dest != source)
+    print_estimate(estimate)
+
+
+def survey_storage(store, conds, params, source, sample):
+    """
+    Get file groups of identified rows, and of an identified sample of
+    the unidentified rows
+    """
+    groups = store.get_groups(conds + ['mime is not null'], params)
+    unidentified = conds + ['mime is null']
+    count = store.get_row_count(unidentified, params)
+    if count:
+        rows = store.get_sample(unidentified, params, sample)
+        groups.extend(identify_sample(rows, source, count))
+
+    return groups
+
+
+def survey_folder(source, sample):
+    """Get file groups of an identified random sample of files in folder"""
+    paths = []
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename), source)
+            count += 1
+            if len(paths) < sample:
+                paths.append(path)
+            else:
+                i = random.randrange(count)
+                if i < sample:
+                    paths[i] = path
+
+    rows = [{'id': None, 'path': path, 'encoding': None, 'status': 'new',
+             'mime': None, 'format': None, 'version': None, 'size': None,
+             'puid': None, 'source_id': None, 'kept': None}
+            for path in paths]
+
+    return identify_sample(rows, source, count)
+
+
+def identify_sample(rows, source, count):
+    """
+    Identify sample rows, and get file groups where each file counts for
+    its share of the `count` files sampled from
+    """
+    if not rows:
+        return []
+    with Pool() as pool:
+        files = pool.starmap(identify, [(row, source) for row in rows])
+
+    weight = count / len(rows)
+    groups = defaultdict(lambda: {'count': 0, 'size': 0})
+    for file in files:
+        key = (file.mime, file.puid, file.ext, file.version, file.encoding)
+        groups[key]['count'] += weight
+        groups[key]['size'] += (file.size or 0) * weight
+
+    return [dict(zip(['mime', 'puid', 'ext', 'version', 'encoding'], key),
+                 **values)
+            for key, values in groups.items()]
+
+
+def identify(row, source):
+    file = File(row, False)
+    source_path = os.path.join(source, file.path)
+    try:
+        file.set_metadata(source_path, source)
+    except Exception:
+        file.mime = file.mime or 'application/octet-stream'
+    if file.size is None and os.path.isfile(source_path):
+        file.size = os.path.getsize(source_path)
+
+    return file
+
+
+def expected_status(group, converter):
+    """Get the status a file in group is expected to get"""
+    file = File({'id': None, 'path': 'file' + (group['ext'] or ''),
+                 'encoding': group['encoding'], 'status': None,
+                 'mime': group['mime'], 'format': None,
+                 'version': group['version'], 'size': None,
+                 'puid': group['puid'], 'source_id': None, 'kept': None},
+                False)
+    accept = file.is_accepted(converter)
+    if converter.get('command'):
+        return 'accepted' if accept else 'converted'
+    elif accept:
+        return 'accepted'
+    elif group['mime'] == 'application/encrypted':
+        return 'protected'
+    elif converter.get('keep') is False:
+        return 'removed'
+    else:
+        return 'skipped'
+
+
+def make_estimate(groups, history, outcomes, output_sizes, copy=True):
+    """
+    Estimate number of files with each status, conversion time and
+    output size for each mime type
+
+    Files expected to be converted are split into converted and failed
+    by the share of failed conversions of the mime type in earlier runs
+    """
+    total_duration = sum(h[0] for h in history.values())
+    total_size = sum(h[1] for h in history.values())
+    limits = get_limits()
+
+    mimes = defaultdict(lambda: defaultdict(float))
+    class_seconds = defaultdict(float)
+    unknown = set()
+    for group in groups:
+        mime = group['mime']
+        count, size = group['count'], group['size'] or 0
+        converter = get_converter(mime, group['puid'], group['ext'])
+        status = expected_status(group, converter)
+        result = mimes[mime]
+        result['files'] += count
+        result['size'] += size
+
+        if status == 'converted':
+            tried = outcomes.get(mime, {})
+            failed = tried.get('failed', 0) + tried.get('timeout', 0)
+            share = failed / sum(tried.values()) if tried else 0
+            result['converted'] += count * (1 - share)
+            result['failed'] += count * share
+        else:
+            result[status] += count
+
+        if converter.get('command'):
+            if mime in history and history[mime][1]:
+                duration, hist_size, hist_count = history[mime]
+                seconds = (size * duration / hist_size if size
+                           else count * duration / hist_count)
+            elif total_size and size:
+                # Use mean conversion rate of all mime types
+                seconds = size * total_duration / total_size
+                unknown.add(mime)
+            else:
+                seconds = 0
+                unknown.add(mime)
+            result['seconds'] += seconds
+            class_seconds[concurrency_class(converter, mime)] += seconds
+
+            if mime in output_sizes and output_sizes[mime][0]:
+                orig_size, conv_size = output_sizes[mime]
+                result['output'] += size * conv_size / orig_size
+            else:
+                result['output'] += size
+                unknown.add(mime)
+            if copy and status == 'accepted':
+                result['output'] += size
+        elif copy and status != 'removed':
+            result['output'] += size
+
+    cpu_seconds = sum(class_seconds.values())
+    # Conversions in a limited class can't use more workers than the limit
+    wall_seconds = max([cpu_seconds / os.cpu_count()] + [
+        seconds / limits[cls] for cls, seconds in class_seconds.items()
+        if cls in limits
+    ])
+
+    return {
+        'mimes': mimes,
+        'cpu_seconds': cpu_seconds,
+        'wall_seconds': wall_seconds,
+        'unknown': unknown
+    }
+
+
+def print_estimate(estimate):
+    mimes = estimate['mimes']
+    # Only show statuses some files are expected to get
+    statuses = [status for status in ['accepted', 'converted', 'failed',
+                                      'skipped', 'removed', 'protected']
+                if any(result[status] for result in mimes.values())]
+    table = Table(title="Estimate")
+    table.add_column("Mime type")
+    table.add_column("Files", justify="right")
+    table.add_column("Size", justify="right")
+    for status in statuses:
+        table.add_column(status.capitalize(), justify="right")
+    table.add_column("CPU time", justify="right")
+    table.add_column("Output size", justify="right")
+
+    totals = defaultdict(float)
+    for mime, result in sorted(mimes.items(), key=lambda m: -m[1]['seconds']):
+        for key, value in result.items():
+            totals[key] += value
+        table.add_row(
+            str(mime), f"{round(result['files'])}", human_size(result['size']),
+            *[f"{round(result[status])}" for status in statuses],
+            duration(result['seconds']) + ('?' if mime in estimate['unknown']
+                                           else ''),
+            human_size(result['output'])
+        )
+    table.add_section()
+    table.add_row("Total", f"{round(totals['files'])}",
+                  human_size(totals['size']),
+                  *[f"{round(totals[status])}" for status in statuses],
+                  duration(totals['seconds']), human_size(totals['output']))
+    console.print(table)
+
+    console.print(f"Estimated run time: {duration(estimate['wall_seconds'])} "
+                  f"with {os.cpu_count()} CPUs", style="bold cyan")
+    console.print(f"Estimated CPU hours: "
+                  f"{round(estimate['cpu_seconds'] / 3600, 1)}",
+                  style="bold cyan")
+    if estimate['unknown']:
+        console.print("? No earlier conversions of some mime types. Their "
+                      "time and output size are guesses", style="orange1")
+
+
+def duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
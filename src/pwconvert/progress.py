@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import Counter
+from rich.progress import (Progress, TextColumn, BarColumn,
+                           MofNCompleteColumn, TimeRemainingColumn)
+
+from .util import human_size
+
+
+class ConversionProgress:
+    """
+    Shows progress of a run in the main process
+
+    The workers return status and size of each file they finish as the
+    result of the job, and the counts are updated from the callbacks of
+    the pool, so that the workers don't report progress themselves
+    """
+
+    def __init__(self, total, description="Converting"):
+        self._progress = Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            MofNCompleteColumn(),
+            TextColumn("{task.fields[rate]}"),
+            TimeRemainingColumn(),
+            TextColumn("{task.fields[statuses]}")
+        )
+        self._task = self._progress.add_task(description, total=total,
+                                             rate='', statuses='')
+        self._lock = threading.Lock()
+        self._statuses = Counter()
+        self._bytes = 0
+        self._t0 = None
+
+    def __enter__(self):
+        self._t0 = time.time()
+        self._progress.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._progress.stop()
+
+    def add_total(self, count):
+        """Add files to convert, e.g. files extracted from archives"""
+        with self._lock:
+            total = self._progress.tasks[0].total or 0
+            self._progress.update(self._task, total=total + count)
+
+    def file_done(self, result):
+        """Count a file the workers have finished, with status and size"""
+        status, size = result if result else (None, None)
+        with self._lock:
+            self._statuses[status or 'unknown'] += 1
+            self._bytes += size or 0
+            self._update()
+
+    def file_failed(self, error):
+        """Count a file where the conversion raised an error"""
+        with self._lock:
+            self._statuses['error'] += 1
+            self._update()
+
+    def _update(self):
+        finished = sum(self._statuses.values())
+        elapsed = max(time.time() - self._t0, 0.001)
+        rate = (f"{finished / elapsed:.1f} files/s "
+                f"{human_size(self._bytes / elapsed)}/s")
+        statuses = ' '.join(f"{status}: {count}" for status, count
+                            in sorted(self._statuses.items()))
+        self._progress.update(self._task, completed=finished, rate=rate,
+                              statuses=statuses)
@@ -0,0 +1,448 @@
+import os
+import math
+import heapq
+import random
+import itertools
+import shlex
+import threading
+import multiprocessing
+import psutil
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+
+from .config import cfg, converters
+from .util import uno_server_ports
+
+# Queues with free slots for each concurrency class, set in each worker
+# by `set_slots` when the pool starts
+_slots = {}
+
+# Timeouts learned from earlier runs, set in each worker by
+# `set_timeouts` when the pool starts
+_timeouts = {}
+
+
+def get_converter(mime, puid=None, ext=None):
+    """Get converter for mime type, with special puid or source-ext applied"""
+    converter = dict(converters[mime]) if mime in converters else {}
+    if 'puid' in converter and puid in converter['puid']:
+        converter.update(converter['puid'][puid])
+    elif 'source-ext' in converter and ext in converter['source-ext']:
+        converter.update(converter['source-ext'][ext])
+
+    return converter
+
+
+def concurrency_class(converter, mime):
+    """
+    Get concurrency class of converter
+
+    A converter with a number as `concurrency` gets a class of its own,
+    named after the mime type
+    """
+    concurrency = converter.get('concurrency')
+    if concurrency is None or concurrency is False:
+        return None
+    if isinstance(concurrency, str):
+        return concurrency
+
+    return mime
+
+
+def converter_tool(converter):
+    """
+    Get name of the program the converter runs
+
+    Placeholders and shell operators before it are skipped, as in
+    `<accept> || iconv ...`
+    """
+    command = converter.get('command')
+    if not command:
+        return None
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        words = command.split()
+    for word in words:
+        word = word.strip(';')
+        if not word or word in ('||', '&&', '|') or (
+            word.startswith('<') and word.endswith('>')
+        ):
+            continue
+        return os.path.basename(word)
+
+    return None
+
+
+def learn_timeouts(store, max_samples=1000):
+    """
+    Learn conversion times from converted files in earlier runs
+
+    Returns dict with mime type, puid and tool as key, and the duration
+    and duration per byte at the configured percentile as value. Keys
+    with too few conversions are left out. Holds a random sample of
+    at most `max_samples` conversions for each key
+    """
+    settings = cfg['timeouts']
+    samples = defaultdict(list)
+    seen = Counter()
+    for mime, puid, tool, duration, size in store.iter_durations():
+        key = (mime, puid, tool)
+        seen[key] += 1
+        sample = (duration, duration / size if size else None)
+        if len(samples[key]) < max_samples:
+            samples[key].append(sample)
+        else:
+            i = random.randrange(seen[key])
+            if i < max_samples:
+                samples[key][i] = sample
+
+    history = {}
+    for key, values in samples.items():
+        if len(values) < settings['min-samples']:
+            continue
+        durations = [duration for duration, rate in values]
+        rates = [rate for duration, rate in values if rate is not None]
+        history[key] = (percentile(durations, settings['percentile']),
+                        percentile(rates, settings['percentile']))
+
+    return history
+
+
+def percentile(values, pct):
+    """Get value at percentile `pct` of values, None if there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    i = max(0, math.ceil(pct / 100 * len(values)) - 1)
+
+    return values[i]
+
+
+def get_timeout(converter, mime, puid, size):
+    """
+    Get timeout for converting a file from the conversion history set by
+    `set_timeouts`
+
+    The timeout is the duration or the duration per byte times the size at
+    the configured percentile, whichever is longest, multiplied by
+    `factor` and kept within `floor` and `ceiling`. Returns None when
+    there's no history for the mime type, puid and tool
+    """
+    settings = cfg['timeouts']
+    learned = _timeouts.get((mime, puid, converter_tool(converter)))
+    if not learned:
+        return None
+    duration, rate = learned
+    expected = max(duration, rate * size if rate and size else 0)
+    timeout = settings['factor'] * expected
+
+    return round(min(max(timeout, settings['floor']), settings['ceiling']))
+
+
+def get_limits():
+    """Get max number of simultaneous conversions for each concurrency class"""
+    limits = {}
+    for cls, limit in (cfg.get('concurrency') or {}).items():
+        if limit == 'unoserver':
+            limit = len(uno_server_ports())
+        if limit:
+            limits[cls] = int(limit)
+
+    for mime, converter in converters.items():
+        entries = [converter]
+        entries.extend((converter.get('puid') or {}).values())
+        entries.extend((converter.get('source-ext') or {}).values())
+        for entry in entries:
+            limit = entry.get('concurrency') if entry else None
+            if limit and not isinstance(limit, str):
+                limits[mime] = int(limit)
+
+    return limits
+
+
+def make_slots(limits):
+    """
+    Make queues holding one token for each free slot in the classes
+
+    Classes limited by `unoserver` hold the ports of the unoserver
+    instances, so that a conversion gets a free instance with its slot
+    """
+    slots = {}
+    classes = cfg.get('concurrency') or {}
+    for cls, limit in limits.items():
+        slots[cls] = multiprocessing.Queue()
+        if classes.get(cls) == 'unoserver':
+            tokens = uno_server_ports()
+        else:
+            tokens = [None] * limit
+        for token in tokens:
+            slots[cls].put(token)
+
+    return slots
+
+
+def uno_slots(slots):
+    """Get the slot queues holding ports of unoserver instances"""
+    classes = cfg.get('concurrency') or {}
+    return [q for cls, q in slots.items() if classes.get(cls) == 'unoserver']
+
+
+def set_slots(slots):
+    """Is called at every process start, to make slots available"""
+    global _slots
+    _slots = slots
+
+
+def set_timeouts(history):
+    """Is called at every process start, to make learned timeouts available"""
+    global _timeouts
+    _timeouts = history or {}
+
+
+def has_slots(cls):
+    """Check if conversions in concurrency class wait for a slot"""
+    return cls in _slots
+
+
+@contextmanager
+def converter_slot(converter, mime):
+    """
+    Wait for a free slot in the concurrency class of converter
+
+    Yields the port of the unoserver instance for classes limited by
+    `unoserver`, otherwise None
+    """
+    cls = concurrency_class(converter, mime)
+    if cls not in _slots:
+        yield None
+        return
+
+    slot = _slots[cls].get()
+    try:
+        yield slot
+    finally:
+        _slots[cls].put(slot)
+
+
+def longest_first(store, conds, params):
+    """
+    Iterate over rows with the most expensive conversions first
+
+    The cost is estimated from the file size and the conversion time per
+    byte of the mime type in earlier runs. Rows of each mime type are read
+    ordered by size, and the mime types merged on estimated cost
+    """
+    history = store.get_durations()
+    total_duration = sum(h[0] for h in history.values())
+    total_size = sum(h[1] for h in history.values())
+    total_count = sum(h[2] for h in history.values())
+    # Use the size as cost when there are no earlier conversions
+    default_rate = total_duration / total_size if total_size else 1
+    default_avg = total_duration / total_count if total_count else 0
+
+    def get_costs(rows, mime):
+        duration, size, count = history.get(mime, (None, 0, 0))
+        rate = duration / size if size else default_rate
+        avg = duration / count if count else default_avg
+        for row in rows:
+            cost = row['size'] * rate if row['size'] else avg
+            yield -cost, row['id'], row
+
+    streams = []
+    for mime in store.get_mimes(conds, params):
+        if mime is None:
+            mime_conds, mime_params = conds + ['mime is null'], params
+        else:
+            mime_conds, mime_params = conds + ['mime = ?'], params + [mime]
+        rows = store.iter_rows(mime_conds, mime_params, order='size',
+                               batch_size=100)
+        streams.append(get_costs(rows, mime))
+
+    for _, _, row in heapq.merge(*streams):
+        yield row
+
+
+def adaptive_bounds(default_max=None):
+    """
+    Get min and max number of simultaneous conversions in adaptive mode
+
+    `max-workers` defaults to `default_max` or the number of CPUs
+    """
+    settings = cfg['adaptive']
+    max_workers = (settings['max-workers'] or default_max
+                   or os.cpu_count())
+    min_workers = min(settings['min-workers'] or 1, max_workers)
+
+    return min_workers, max_workers
+
+
+def watch_load(scheduler, stop, bounds):
+    """
+    Adjust number of simultaneous conversions to the system load until
+    `stop` is set
+
+    Shrinks by one when memory is low, the system swaps or the load
+    is too high, and halves when memory is used up. Grows by one when
+    there's twice the memory needed and the load is below the max
+    """
+    settings = cfg['adaptive']
+    min_workers, max_workers = bounds
+    min_free = settings['min-free-memory'] * 1024 * 1024
+    max_load = settings['max-load'] or os.cpu_count()
+    max_swap_in = settings['max-swap-in'] * 1024 * 1024
+    interval = settings['interval']
+    swapped_in = psutil.swap_memory().sin
+    while not stop.wait(interval):
+        available = psutil.virtual_memory().available
+        load = os.getloadavg()[0]
+        swap = psutil.swap_memory()
+        swap_rate = (swap.sin - swapped_in) / interval
+        swapped_in = swap.sin
+
+        workers = scheduler.max_in_flight
+        if available < min_free / 2:
+            workers = workers // 2
+        elif (
+            available < min_free or swap_rate > max_swap_in
+            or load > max_load
+        ):
+            workers -= 1
+        elif available > 2 * min_free and load < max_load - 1:
+            workers += 1
+
+        workers = max(min_workers, min(workers, max_workers))
+        if workers != scheduler.max_in_flight:
+            scheduler.resize(workers)
+
+
+class Scheduler:
+    """
+    Submits jobs to a pool, holding back jobs in concurrency classes
+    that have reached their limit, so that other jobs keep flowing
+    """
+
+    def __init__(self, pool, max_in_flight, limits, error_callback=None,
+                 callback=None):
+        self._pool = pool
+        self._max_in_flight = max_in_flight
+        self._limits = limits
+        self._error_callback = error_callback
+        self._callback = callback
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._running = Counter()
+        self._deferred = defaultdict(deque)
+        self._deferred_count = 0
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._cancelled = False
+
+    def submit(self, func, args, cls=None):
+        """
+        Submit job, waiting while the scheduler is full
+
+        Returns False if the scheduler is cancelled, and the job not
+        submitted
+        """
+        with self._cond:
+            while True:
+                if self._cancelled:
+                    return False
+                self._dispatch_deferred()
+                limited = self._is_limited(cls)
+                if not limited and self._in_flight < self._max_in_flight:
+                    self._apply(func, args, cls)
+                    return True
+                if limited and self._deferred_count < self._max_in_flight:
+                    self._deferred[cls].append((func, args))
+                    self._deferred_count += 1
+                    return True
+                self._cond.wait()
+
+    @property
+    def max_in_flight(self):
+        return self._max_in_flight
+
+    def resize(self, max_in_flight):
+        """
+        Change max number of jobs in the pool
+
+        Jobs already in the pool are left running when the scheduler shrinks
+        """
+        with self._cond:
+            self._max_in_flight = max_in_flight
+            self._cond.notify_all()
+
+    def cancel(self):
+        """
+        Stop submitting jobs, and drop jobs waiting for their class
+
+        Jobs in the pool are left running. Returns args of dropped jobs
+        """
+        with self._cond:
+            self._cancelled = True
+            dropped = [args for jobs in self._deferred.values()
+                       for func, args in jobs]
+            self._deferred.clear()
+            self._deferred_count = 0
+            self._cond.notify_all()
+
+        return dropped
+
+    def in_flight_jobs(self):
+        """Get args of jobs in the pool"""
+        with self._cond:
+            return list(self._jobs.values())
+
+    def wait_idle(self, timeout):
+        """
+        Wait until all submitted jobs are finished, or a job finishes or
+        `timeout` seconds pass. Returns True if all jobs are finished
+        """
+        with self._cond:
+            self._dispatch_deferred()
+            if self._in_flight or self._deferred_count:
+                self._cond.wait(timeout)
+                self._dispatch_deferred()
+
+            return not self._in_flight and not self._deferred_count
+
+    def _is_limited(self, cls):
+        return cls in self._limits and self._running[cls] >= self._limits[cls]
+
+    def _dispatch_deferred(self):
+        for cls, jobs in self._deferred.items():
+            while (
+                jobs and self._in_flight < self._max_in_flight
+                and not self._is_limited(cls)
+            ):
+                func, args = jobs.popleft()
+                self._deferred_count -= 1
+                self._apply(func, args, cls)
+
+    def _apply(self, func, args, cls):
+        self._in_flight += 1
+        self._running[cls] += 1
+        job_id = next(self._job_ids)
+        self._jobs[job_id] = args
+
+        def done(result):
+            if self._callback:
+                self._callback(result)
+            self._job_done(cls, job_id)
+
+        def failed(error):
+            if self._error_callback:
+                self._error_callback(error)
+            self._job_done(cls, job_id)
+
+        self._pool.apply_async(func, args=args, callback=done,
+                               error_callback=failed)
+
+    def _job_done(self, cls, job_id):
+        with self._cond:
+            del self._jobs[job_id]
+            self._in_flight -= 1
+            self._running[cls] -= 1
+            self._cond.notify()
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import base64
+import socket
+import threading
+import tempfile
+import subprocess
+import http.client
+from multiprocessing.pool import ThreadPool
+
+from .config import cfg
+
+# Connections to the Siegfried server, one for each thread
+_local = threading.local()
+
+
+def server_address():
+    """Get host and port of the Siegfried server, or None if not used"""
+    address = cfg['siegfried']['serve']
+    if not address:
+        return None
+    host, port = address.rsplit(':', 1)
+
+    return host, int(port)
+
+
+def sf_server_running() -> bool:
+    host, port = server_address()
+    try:
+        with socket.create_connection((host, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def start_sf_server():
+    """
+    Start `sf -serve`, so that the signature file is only loaded once,
+    and wait until it accepts connections
+    """
+    if not server_address() or sf_server_running():
+        return
+    try:
+        proc = subprocess.Popen(
+            ['sf', '-serve', cfg['siegfried']['serve']],
+            start_new_session=True,
+            close_fds=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+    except OSError as e:
+        print(f"Couldn't start Siegfried server: {e}", flush=True)
+        return
+    for _ in range(30):
+        if sf_server_running() or proc.poll() is not None:
+            return
+        time.sleep(1)
+
+
+def version():
+    """
+    Get version of Siegfried with its signature file, as reported by
+    `sf -version`, or None if it can't be run
+    """
+    try:
+        p = subprocess.run(['sf', '-version'], capture_output=True,
+                           text=True, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    return p.stdout.strip() or None
+
+
+def identify(path):
+    """
+    Identify file with Siegfried
+
+    Uses the Siegfried server when it's configured, and runs `sf` for the
+    file if the server can't be reached. Returns the `files` entry of the
+    JSON output, or None if the file couldn't be identified
+    """
+    if server_address():
+        try:
+            return query_server(path)
+        except (OSError, http.client.HTTPException, ValueError):
+            _local.conn = None
+
+    p = subprocess.Popen(['sf', '-json', path], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if err:
+        return None
+
+    return json.loads(out)['files'][0]
+
+
+def query_server(path):
+    """Identify file on a connection kept open to the Siegfried server"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        host, port = server_address()
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        _local.conn = conn
+
+    encoded = base64.urlsafe_b64encode(path.encode()).decode()
+    conn.request('GET', f"/identify/{encoded}?base64=true&format=json")
+    response = conn.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise ValueError(f"Siegfried responded {response.status}")
+
+    return json.loads(body)['files'][0]
+
+
+def identify_files(files, source_dir, threads=8):
+    """
+    Identify many files at once, with the Siegfried server when it's
+    configured, or else with one run of `sf` for all of them
+
+    The results are set on the `File` objects, to be used by
+    `File.set_metadata` instead of identifying each file again
+    """
+    paths = [os.path.join(source_dir, file.path) for file in files]
+    if server_address():
+        with ThreadPool(threads) as pool:
+            results = pool.map(identify_or_none, paths)
+    else:
+        results = identify_paths(paths)
+
+    for file, info in zip(files, results):
+        file._siegfried = info
+
+
+def identify_paths(paths):
+    """
+    Identify files with one run of `sf`, so that the signature file is
+    only loaded once for all of them
+
+    Returns the `files` entries of the JSON output in the order of
+    `paths`, with None for files missing in the output. These are
+    identified one at a time later
+    """
+    if not paths:
+        return []
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+        f.write('\n'.join(paths))
+        f.flush()
+        try:
+            p = subprocess.run(['sf', '-json', '-f', f.name],
+                               capture_output=True)
+            found = {info['filename']: info
+                     for info in json.loads(p.stdout)['files']}
+        except (OSError, ValueError, KeyError, TypeError):
+            found = {}
+
+    return [found.get(path) for path in paths]
+
+
+def identify_or_none(path):
+    try:
+        return identify(path)
+    except Exception:
+        return None
+
+
+def get_match(info):
+    """Get mime type, format, version, size and puid from Siegfried result"""
+    match = info['matches'][0]
+
+    return {
+        'mime': match['mime'],
+        'format': match['format'],
+        'version': match['version'],
+        'size': info['filesize'],
+        'puid': match['id'],
+    }
@@ -0,0 +1,59 @@
+import threading
+import magic
+
+# libmagic doesn't look further into a file than this by default
+HEADER_SIZE = 1024 * 1024
+
+# Magic cookies of each worker, made on first use
+_local = threading.local()
+
+
+def get_cookies():
+    """Get magic cookies for mime type with encoding, and for description"""
+    if not hasattr(_local, 'mime'):
+        _local.mime = magic.Magic(mime=True, mime_encoding=True)
+        _local.description = magic.Magic()
+
+    return _local.mime, _local.description
+
+
+def version():
+    """Get version of libmagic, or None if it's too old to tell"""
+    try:
+        return str(magic.version())
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def read_header(path, size=HEADER_SIZE):
+    """Read start of file, or an empty buffer if it can't be read"""
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            return f.read(size)
+    except OSError:
+        return b''
+
+
+def sniff(path, header=None):
+    """
+    Identify file with libmagic, without running the `file` command
+
+    Uses `header` as the start of the file, or reads it, and returns
+    mime type, encoding and format like `file -i -b` and `file -b` would
+    """
+    mime_cookie, description_cookie = get_cookies()
+    if header is None:
+        header = read_header(path)
+
+    if header:
+        mime_type = mime_cookie.from_buffer(header)
+        description = description_cookie.from_buffer(header)
+    else:
+        # Let libmagic report empty and unreadable files as `file` does
+        mime_type = mime_cookie.from_file(path)
+        description = description_cookie.from_file(path)
+
+    mime, _, charset = mime_type.partition(';')
+    encoding = charset.replace('charset=', '').strip() or None
+
+    return mime.strip(), encoding, description.split(',')[0]
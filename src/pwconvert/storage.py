@@ -1,12 +1,16 @@
 import os
+import json
+import socket
+import datetime
 import sqlite3
+import psutil
 import pymysql
 from sqlite3 import Connection
 from typing import Optional
 from pathlib import Path
 
 import petl
-from petl import appenddb, fromdb, todb
+from petl import fromdb, todb
 from .config import cfg
 
 
@@ -36,6 +40,25 @@ class Storage:
     );
     """
 
+    _create_run = """
+    CREATE TABLE run(
+        id integer auto_increment primary key,
+        started datetime,
+        finished datetime,
+        status varchar(10),
+        host varchar(100),
+        pid int,
+        options text
+    );
+    """
+
+    _create_meta = """
+    CREATE TABLE meta(
+        name varchar(100) primary key,
+        value varchar(1000)
+    );
+    """
+
     _create_view_file_root = """
     create view file_root as
     with recursive cte as (
@@ -53,10 +76,40 @@ class Storage:
     order by path;
     """
 
+    # Columns and indexes added after the first version of the file table.
+    # They are added to existing databases when these are opened
+    _added_columns = {
+        'duration': 'float',
+        'lease_owner': 'varchar(100)',
+        'lease_expires': 'datetime',
+        'run_id': 'int',
+        'tool': 'varchar(100)',
+        'checksum': 'varchar(128)',
+        'checksum_type': 'varchar(20)',
+        'reused_from': 'int',
+        'mtime': 'double',
+        'inode': 'bigint',
+    }
+
+    _added_tables = {
+        'run': _create_run,
+        'meta': _create_meta,
+    }
+
+    _added_indexes = {
+        'file_size': 'size',
+        'file_mime_size': 'mime, size',
+        'file_lease_owner': 'lease_owner',
+        'file_run_id': 'run_id',
+        'file_checksum': 'checksum',
+    }
+
     def __init__(self, path: str):
         self._conn = Optional[Connection]
         self.path = path
         self.system = 'sqlite' if '.' in path else 'mysql'
+        # Whether paths of original files have a unique index
+        self._unique_paths = False
 
     def __enter__(self):
         self.load_data_source()
@@ -72,6 +125,10 @@ class Storage:
                 os.makedirs(storage_dir)
 
             self._conn = sqlite3.connect(self.path)
+            # Let workers read while the results are written, and only
+            # sync the database at checkpoints, which is safe with WAL
+            self._conn.execute('PRAGMA journal_mode=wal')
+            self._conn.execute('PRAGMA synchronous=normal')
 
             query = """
                 SELECT name FROM sqlite_master 
@@ -115,6 +172,132 @@ class Storage:
             cursor.execute("CREATE INDEX file_status_ts on file(status_ts)")
             cursor.execute(self._create_view_file_root)
             cursor.execute(self._create_file_content)
+            self._create_unique_path_index(cursor)
+        self.upgrade_schema(cursor)
+        self._conn.commit()
+
+    def upgrade_schema(self, cursor):
+        """Add tables, columns and indexes missing in databases made by older versions"""
+        if self.system == 'sqlite':
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        else:
+            cursor.execute("""
+                SELECT table_name FROM information_schema.tables
+                WHERE table_schema = %s
+            """, (self.path,))
+        tables = [row[0] for row in cursor.fetchall()]
+
+        for table, sql in self._added_tables.items():
+            if table not in tables:
+                if self.system == 'sqlite':
+                    sql = sql.replace('auto_increment', '')
+                cursor.execute(sql)
+
+        if self.system == 'sqlite':
+            cursor.execute("PRAGMA table_info(file)")
+            columns = [row[1] for row in cursor.fetchall()]
+            cursor.execute("""
+                SELECT name FROM sqlite_master
+                WHERE type = 'index' AND tbl_name = 'file'
+            """)
+        else:
+            cursor.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = 'file'
+            """, (self.path,))
+            columns = [row[0] for row in cursor.fetchall()]
+            cursor.execute("""
+                SELECT DISTINCT index_name FROM information_schema.statistics
+                WHERE table_schema = %s AND table_name = 'file'
+            """, (self.path,))
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        for column, datatype in self._added_columns.items():
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE file ADD COLUMN {column} {datatype}")
+
+        for index, index_columns in self._added_indexes.items():
+            if index not in indexes:
+                cursor.execute(f"CREATE INDEX {index} on file({index_columns})")
+
+        self._unique_paths = 'file_original_path' in indexes
+
+    def add_unique_path_index(self):
+        """
+        Make paths of original files unique, so that files can be added
+        again without being duplicated
+
+        Returns False if the index can't be made because the database
+        already has duplicates. This is recorded, so that it's only tried
+        once. On MySQL, the table is rewritten with a column for the index
+        """
+        if self._unique_paths:
+            return True
+        if self.get_meta('unique-paths') == 'duplicates':
+            return False
+
+        print('adding unique index on paths of original files ...',
+              flush=True)
+        cursor = self._conn.cursor()
+        try:
+            self._create_unique_path_index(cursor)
+        except (sqlite3.IntegrityError, pymysql.err.IntegrityError):
+            self._conn.rollback()
+            print("couldn't add index, the database has duplicate paths",
+                  flush=True)
+            self.set_meta('unique-paths', 'duplicates')
+            return False
+
+        self._conn.commit()
+        self._unique_paths = True
+
+        return True
+
+    def _create_unique_path_index(self, cursor):
+        """
+        MySQL has no partial indexes, and can't index the full path, so
+        a hash of the paths of original files is indexed instead
+        """
+        if self.system == 'sqlite':
+            cursor.execute("""
+                CREATE UNIQUE INDEX file_original_path ON file(path)
+                WHERE source_id IS NULL
+            """)
+            return
+
+        cursor.execute("""
+            SELECT count(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = 'file'
+              AND column_name = 'original_path_hash'
+        """, (self.path,))
+        if not cursor.fetchone()[0]:
+            cursor.execute("""
+                ALTER TABLE file ADD COLUMN original_path_hash
+                char(64) AS (IF(source_id IS NULL, SHA2(path, 256),
+                                NULL)) STORED
+            """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX file_original_path
+            ON file(original_path_hash)
+        """)
+
+    def get_meta(self, name):
+        """Get value stored about the database, None if it's not set"""
+        sql = "select value from meta where name = ?"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (name,))
+        row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        sql = "replace into meta (name, value) values (?, ?)"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (name, value))
         self._conn.commit()
 
     def close_data_source(self):
@@ -124,20 +307,55 @@ class Storage:
     def import_rows(self, table):
         todb(table, self._conn, "file")
 
-    def append_rows(self, table):
-        # select the first row (primary key) and filter away rows that already exist
+    def append_rows(self, table, chunk_size=500):
+        """Add rows of petl table for files that aren't in the database"""
+        self.add_new_rows(list(petl.header(table)), petl.data(table),
+                          chunk_size)
+
+    def add_new_rows(self, cols, rows, chunk_size=500):
+        """
+        Add rows of files that aren't in the database already
+
+        `rows` is an iterable of tuples with values of `cols`. Rows of
+        existing files are ignored by the unique index on paths of
+        original files. The rows are inserted a chunk at a time, so memory
+        doesn't grow with the size of the database or the number of rows
+        """
+        self.add_unique_path_index()
+        ignore = 'or ignore' if self.system == 'sqlite' else 'ignore'
+        sql = "insert {} into file ({}) values ({})".format(
+            ignore, ', '.join(cols), ', '.join('?' for col in cols))
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
 
         cursor = self._conn.cursor()
+        chunk = []
+        for row in rows:
+            chunk.append(tuple(row))
+            if len(chunk) == chunk_size:
+                self._insert_new(cursor, sql, cols, chunk)
+                chunk = []
+        if chunk:
+            self._insert_new(cursor, sql, cols, chunk)
+        self._conn.commit()
 
-        cursor.execute("SELECT path FROM file")
-        rows = cursor.fetchall()
-        file_names = [row[0] for row in rows]
-        table = petl.select(
-            table,
-            lambda rec: (rec.path not in file_names)
-        )
-        # append new rows
-        appenddb(table, self._conn, "file")
+    def _insert_new(self, cursor, sql, cols, rows):
+        if not self._unique_paths:
+            # Look up the paths of the chunk in databases that already
+            # have duplicates, and can't have the unique index
+            i = cols.index('path')
+            marks = ', '.join(['?'] * len(rows))
+            select = f"""
+            select path from file
+            where source_id is null and path in ({marks})
+            """
+            if self.system == 'mysql':
+                select = select.replace('?', '%s')
+            cursor.execute(select, [row[i] for row in rows])
+            existing = set(row[0] for row in cursor.fetchall())
+            rows = [row for row in rows if row[i] not in existing]
+
+        cursor.executemany(sql, rows)
 
     def get_kept_rec(self, path):
         sql = "select * from file where path = ? and (kept = 1 or status = 'new')"
@@ -166,8 +384,6 @@ class Storage:
             sql = sql.replace('?', '%s')
         sql += ' WHERE id = ' + str(id)
         cursor = self._conn.cursor()
-        if self.system == 'sqlite':
-            cursor.execute('PRAGMA journal_mode=wal')
         try:
             cursor.execute(sql, tuple(v for k, v in data.items()
                                       if k != 'id' and not k.startswith('_')))
@@ -185,8 +401,6 @@ class Storage:
             sql = sql.replace('?', '%s')
 
         cursor = self._conn.cursor()
-        if self.system == 'sqlite':
-            cursor.execute('PRAGMA journal_mode=wal')
         try:
             cursor.execute(sql, tuple(v for k, v in data.items()
                                       if k != 'id' and not k.startswith('_')))
@@ -195,6 +409,156 @@ class Storage:
 
         self._conn.commit()
 
+    def log_rows(self, rows: list[dict]):
+        """
+        Update and insert rows of many files in one transaction, with one
+        statement for each set of columns
+
+        Rows with id are updated, and rows without id inserted. If the
+        transaction fails, the rows are written one at a time instead
+        """
+        groups = {}
+        for data in rows:
+            cols = tuple(k for k in data
+                         if k != 'id' and not k.startswith('_'))
+            groups.setdefault((bool(data['id']), cols), []).append(data)
+
+        cursor = self._conn.cursor()
+        try:
+            for (update, cols), group in groups.items():
+                if update:
+                    sql = "UPDATE file SET {} WHERE id = ?".format(
+                        ', '.join(f"{k}=?" for k in cols))
+                    params = [[data[k] for k in cols] + [data['id']]
+                              for data in group]
+                else:
+                    sql = "insert into file ({}) values ({})".format(
+                        ', '.join(cols), ', '.join('?' for k in cols))
+                    params = [[data[k] for k in cols] for data in group]
+                if self.system == 'mysql':
+                    sql = sql.replace('?', '%s')
+                cursor.executemany(sql, params)
+        except Exception:
+            self._conn.rollback()
+            for data in rows:
+                if data['id']:
+                    self.update_row(data)
+                else:
+                    self.add_row(data)
+            return
+
+        self._conn.commit()
+
+    def add_members(self, source_id, paths, run_id=None, lease=None):
+        """
+        Register files extracted from an archive, and return their rows
+
+        With `lease` as owner and seconds, the rows are leased to the
+        owner, so that other workers don't claim them
+        """
+        owner, expires = None, None
+        if lease:
+            owner = lease[0]
+            expires = (datetime.datetime.now()
+                       + datetime.timedelta(seconds=lease[1]))
+        sql = """
+        insert into file (path, status, source_id, kept, run_id,
+                          lease_owner, lease_expires)
+        values (?, ?, ?, ?, ?, ?, ?)
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        rows = []
+        for path in paths:
+            cursor.execute(sql, (path, 'new', source_id, False, run_id,
+                                 owner, expires))
+            rows.append({
+                'id': cursor.lastrowid, 'path': path, 'encoding': None,
+                'status': 'new', 'mime': None, 'format': None,
+                'version': None, 'size': None, 'puid': None,
+                'source_id': source_id, 'kept': False
+            })
+        self._conn.commit()
+
+        return rows
+
+    def update_identification(self, rows, batch_size=1000):
+        """
+        Write identification of many files at once
+
+        `rows` are dicts with id, puid, mime, format, version, encoding,
+        size, checksum and checksum type of each file
+        """
+        fields = ['puid', 'mime', 'format', 'version', 'encoding', 'size',
+                  'checksum', 'checksum_type']
+        sql = "update file set {} where id = ?".format(
+            ', '.join(f"{field} = ?" for field in fields))
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(sql, [
+                [row[field] for field in fields] + [row['id']]
+                for row in rows[i:i + batch_size]
+            ])
+        self._conn.commit()
+
+    def get_outputs(self, checksum, checksum_type, since, limit=10):
+        """
+        Get original files with checksum that are converted since `since`,
+        with the path of each of their child files as `output`
+        """
+        sql = """
+        select f.id, f.path, f.mime, f.puid, c.path as output
+        from   file f join file c on c.source_id = f.id
+        where  f.checksum = ? and f.checksum_type = ?
+          and  f.source_id is null and f.status in (?, ?, ?)
+          and  f.status_ts >= ?
+        """
+        sql += " LIMIT " + str(limit)
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (checksum, checksum_type, 'converted', 'accepted',
+                             'renamed', since))
+        cols = [col[0] for col in cursor.description]
+
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def replace_content(self, id, chunks):
+        """
+        Replace text content of file with the joined chunks, in one write
+
+        Appending each chunk to the value in the database would rewrite
+        the whole value every time. The full text is held in memory, which
+        is bounded by `max-text-size` when the chunks come from
+        `File.iter_text`
+        """
+        content = ''.join(chunks)
+        if not content:
+            return
+        sqls = [
+            "delete from file_content where file_id = ?",
+            "insert into file_content(file_id, content) values (?, ?)"
+        ]
+        if self.system == 'mysql':
+            sqls = [sql.replace('?', '%s') for sql in sqls]
+        delete, insert = sqls
+
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(delete, (id,))
+            cursor.execute(insert, (id, content))
+        except Exception:
+            self._conn.rollback()
+            raise
+
+        self._conn.commit()
+
     def write_content(self, id, content):
         sql = "select count(*) from file_content where file_id = ?"
         cursor = self._conn.cursor()
@@ -247,8 +611,6 @@ class Storage:
 
     def get_row_count(self, conds=[], params=[]):
         cursor = self._conn.cursor()
-        if self.system == 'sqlite':
-            cursor.execute('PRAGMA journal_mode=wal')
         query = "SELECT COUNT(*) FROM file"
 
         if len(conds):
@@ -262,6 +624,13 @@ class Storage:
 
         return count
 
+    def get_max_id(self):
+        """Get highest id in the file table, 0 if it's empty"""
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT max(id) FROM file")
+
+        return cursor.fetchone()[0] or 0
+
     def get_all_rows(self, unpacked_path):
 
         if unpacked_path:
@@ -295,7 +664,8 @@ class Storage:
 
     def get_conds(self, mime=None, puid=None, status=None, reconvert=False,
                   finished=False, subpath=None, from_path=None, to_path=None,
-                  timestamp=None, original=False, ext=None, retry=False):
+                  timestamp=None, original=False, ext=None, retry=False,
+                  max_id=None):
 
         conds = []
         params = []
@@ -357,6 +727,13 @@ class Storage:
                 conds.append("status_ts > ?")
             params.append(timestamp)
 
+        # Leave out files registered after the selection was made, e.g.
+        # files extracted from archives, which are converted as they are
+        # extracted
+        if max_id is not None:
+            conds.append("id <= ?")
+            params.append(max_id)
+
         return conds, params
 
     def get_rows(self, conds, params, limit=None):
@@ -378,6 +755,372 @@ class Storage:
 
         return fromdb(self._conn, select, params)
 
+    def iter_rows(self, conds, params, order='path', batch_size=1000):
+        """
+        Iterate over rows, fetching `batch_size` rows at a time
+
+        Rows are ordered by path, or by size with largest files first when
+        `order` is 'size'. Uses keyset pagination on the order column and id,
+        so only one batch is held in memory, and the connection is free for
+        other queries between batches
+        """
+        col, desc = ('size', True) if order == 'size' else ('path', False)
+        last = None
+        while True:
+            page_conds = list(conds)
+            page_params = list(params)
+            if last:
+                cond, cond_params = self._keyset_cond(col, desc, last)
+                page_conds.append(cond)
+                page_params.extend(cond_params)
+
+            select = "SELECT * from file"
+            if len(page_conds):
+                select += " WHERE " + ' AND '.join(page_conds)
+            select += f" ORDER BY {col}{' DESC' if desc else ''}, id"
+            select += " LIMIT " + str(batch_size)
+
+            if self.system == 'mysql':
+                select = select.replace('?', '%s')
+
+            cursor = self._conn.cursor()
+            cursor.execute(select, page_params)
+            cols = [col[0] for col in cursor.description]
+            rows = cursor.fetchall()
+
+            for row in rows:
+                last = dict(zip(cols, row))
+                yield last
+
+            if len(rows) < batch_size:
+                break
+
+    def _keyset_cond(self, col, desc, last):
+        """
+        Condition for rows after `last` in the order of `col` and id
+
+        Both SQLite and MySQL sort null values first, so they come last
+        in descending order
+        """
+        value = last[col]
+        if value is None and desc:
+            return f"({col} is null and id > ?)", [last['id']]
+        elif value is None:
+            return f"(({col} is null and id > ?) or {col} is not null)", [last['id']]
+        elif desc:
+            return (f"({col} < ? or ({col} = ? and id > ?) or {col} is null)",
+                    [value, value, last['id']])
+        else:
+            return (f"({col} > ? or ({col} = ? and id > ?))",
+                    [value, value, last['id']])
+
+    def get_mimes(self, conds, params):
+        """Get distinct mime types of rows matching `conds`"""
+        select = "SELECT DISTINCT mime FROM file"
+        if len(conds):
+            select += " WHERE " + ' AND '.join(conds)
+
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_groups(self, conds, params):
+        """
+        Get number of files and total size for each combination of mime
+        type, puid, extension, version and encoding of rows matching `conds`
+        """
+        select = """
+        SELECT mime, puid, ext, version, encoding, count(*), sum(size)
+        FROM file
+        """
+        if len(conds):
+            select += " WHERE " + ' AND '.join(conds)
+        select += " GROUP BY mime, puid, ext, version, encoding"
+
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+        cols = ['mime', 'puid', 'ext', 'version', 'encoding', 'count', 'size']
+
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def get_sample(self, conds, params, size):
+        """Get random sample of `size` rows matching `conds`"""
+        select = "SELECT * from file"
+        if len(conds):
+            select += " WHERE " + ' AND '.join(conds)
+        if self.system == 'mysql':
+            select += " ORDER BY rand() LIMIT " + str(size)
+            select = select.replace('?', '%s')
+        else:
+            select += " ORDER BY random() LIMIT " + str(size)
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+        cols = [col[0] for col in cursor.description]
+
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def get_outcomes(self):
+        """
+        Get number of original files with each status for each mime type
+        among files a conversion has been tried on
+        """
+        select = """
+        SELECT mime, status, count(*) FROM file
+        WHERE  source_id is null and status in (?, ?, ?, ?)
+        GROUP BY mime, status
+        """
+        params = ['converted', 'failed', 'timeout', 'protected']
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+        outcomes = {}
+        for mime, status, count in cursor.fetchall():
+            outcomes.setdefault(mime, {})[status] = count
+
+        return outcomes
+
+    def get_output_sizes(self):
+        """
+        Get total size of converted originals and of their converted
+        files for each mime type
+        """
+        select = """
+        SELECT f.mime, sum(f.size), sum(c.size)
+        FROM   file f JOIN file c ON c.source_id = f.id
+        WHERE  f.status = ?
+        GROUP BY f.mime
+        """
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, ('converted',))
+
+        return {row[0]: (row[1] or 0, row[2] or 0)
+                for row in cursor.fetchall()}
+
+    def get_durations(self):
+        """
+        Get conversion history for each mime type
+
+        Returns dict with mime type as key, and total duration in seconds,
+        total size in bytes and number of converted files as value
+        """
+        select = """
+        SELECT mime, sum(duration), sum(size), count(*) FROM file
+        WHERE  duration is not null
+        GROUP BY mime
+        """
+
+        cursor = self._conn.cursor()
+        cursor.execute(select)
+
+        return {row[0]: (row[1], row[2] or 0, row[3])
+                for row in cursor.fetchall()}
+
+    def iter_durations(self, batch_size=10000):
+        """
+        Iterate over mime type, puid, conversion tool, duration and size
+        of converted files
+        """
+        select = """
+        SELECT mime, puid, tool, duration, size FROM file
+        WHERE  duration is not null and status = ?
+        """
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, ('converted',))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def claim_rows(self, conds, params, owner, seconds, limit):
+        """
+        Lease up to `limit` rows matching `conds` for `seconds`
+
+        Rows leased by other workers are skipped until the lease expires,
+        so that rows held by a worker that crashed are claimed again.
+        Returns the claimed rows
+        """
+        conds = conds + ['(lease_expires is null or lease_expires < ?)']
+        cursor = self._conn.cursor()
+        while True:
+            now = datetime.datetime.now().replace(microsecond=0)
+            expires = now + datetime.timedelta(seconds=seconds)
+
+            select = f"""
+            SELECT id FROM file
+            WHERE {' AND '.join(conds)}
+            ORDER BY path LIMIT {limit}
+            """
+            if self.system == 'mysql':
+                select = select.replace('?', '%s')
+            cursor.execute(select, params + [now])
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return []
+
+            # Other workers may have claimed some of the rows since they
+            # were selected, so the lease is checked again
+            marks = ', '.join(['?'] * len(ids))
+            sql = f"""
+            UPDATE file SET lease_owner = ?, lease_expires = ?
+            WHERE id IN ({marks})
+              AND (lease_expires is null or lease_expires < ?)
+            """
+            select = f"""
+            SELECT * FROM file
+            WHERE id IN ({marks}) AND lease_owner = ? AND lease_expires = ?
+            ORDER BY path
+            """
+            if self.system == 'mysql':
+                sql = sql.replace('?', '%s')
+                select = select.replace('?', '%s')
+            cursor.execute(sql, [owner, expires] + ids + [now])
+            self._conn.commit()
+
+            cursor.execute(select, ids + [owner, expires])
+            cols = [col[0] for col in cursor.description]
+            rows = [dict(zip(cols, row)) for row in cursor.fetchall()]
+            if rows:
+                return rows
+
+    def renew_leases(self, owner, seconds, timestamp):
+        """Extend leases of rows not finished since `timestamp`"""
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        sql = """
+        UPDATE file SET lease_expires = ?
+        WHERE lease_owner = ? AND (status_ts is null or status_ts < ?)
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (expires.replace(microsecond=0), owner, timestamp))
+        self._conn.commit()
+
+    def release_leases(self, owner):
+        """Release all rows leased by owner"""
+        sql = """
+        UPDATE file SET lease_owner = null, lease_expires = null
+        WHERE lease_owner = ?
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (owner,))
+        self._conn.commit()
+
+    def add_run(self, started, options):
+        """Register a run of `pw convert`, and return its id"""
+        sql = """
+        insert into run (started, status, host, pid, options)
+        values (?, ?, ?, ?, ?)
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (started, 'running', socket.gethostname(),
+                             os.getpid(), json.dumps(options)))
+        self._conn.commit()
+
+        return cursor.lastrowid
+
+    def resume_run(self, id):
+        """Register that an interrupted run is continued by this process"""
+        sql = "update run set host = ?, pid = ? where id = ?"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (socket.gethostname(), os.getpid(), id))
+        self._conn.commit()
+
+    def finish_run(self, id, status='finished'):
+        sql = "update run set finished = ?, status = ? where id = ?"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (datetime.datetime.now(), status, id))
+        self._conn.commit()
+
+    def get_interrupted_run(self):
+        """
+        Get the last run that didn't finish, if its process has stopped
+
+        Runs started on other hosts can't be checked, and are regarded
+        as interrupted
+        """
+        sql = "select * from run where status in (?, ?) order by id desc"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, ('running', 'interrupted'))
+        cols = [col[0] for col in cursor.description]
+        for row in cursor.fetchall():
+            run = dict(zip(cols, row))
+            if isinstance(run['started'], str):
+                run['started'] = datetime.datetime.fromisoformat(run['started'])
+            run['options'] = json.loads(run['options'] or '{}')
+            if (
+                run['status'] == 'interrupted'
+                or run['host'] != socket.gethostname()
+                or not psutil.pid_exists(run['pid'])
+            ):
+                return run
+
+        return None
+
+    def mark_in_progress(self, ids, run_id):
+        """Mark rows as handed out for conversion in run"""
+        marks = ', '.join(['?'] * len(ids))
+        sql = f"update file set run_id = ? where id in ({marks})"
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, [run_id] + list(ids))
+        self._conn.commit()
+
+    def mark_for_retry(self, ids):
+        """Reset status of rows where conversion was stopped"""
+        if not ids:
+            return
+        marks = ', '.join(['?'] * len(ids))
+        sql = f"""
+        update file set status = ?, status_ts = null
+        where id in ({marks})
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, ['new'] + list(ids))
+        self._conn.commit()
+
+    def get_in_progress(self, run):
+        """Get ids of rows that were in progress when run was interrupted"""
+        sql = """
+        select id from file
+        where run_id = ? and (status_ts is null or status_ts < ?)
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        cursor = self._conn.cursor()
+        cursor.execute(sql, (run['id'], run['started']))
+
+        return set(row[0] for row in cursor.fetchall())
+
     def get_all(self, conds, params):
         select = "SELECT * from file"
 
@@ -477,8 +1220,6 @@ class Storage:
             sql = sql.replace('?', '%s')
 
         cursor = self._conn.cursor()
-        if self.system == 'sqlite':
-            cursor.execute('PRAGMA journal_mode=wal')
         params = [id]
         cursor.execute(sql, params)
         return cursor.fetchall()
@@ -3,13 +3,19 @@ import re
 import shutil
 import subprocess
 import os
+import queue
 import signal
+import socket
+import tempfile
 import zipfile
+import hashlib
 import psutil
 import time
-import petl as etl
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pwconvert.config import cfg
 from pwconvert.storage import Storage
+from pwconvert.engine import get_engine
 
 
 def run_shell_cmd(command, cwd=None, timeout=None,
@@ -25,6 +31,10 @@ def run_shell_cmd(command, cwd=None, timeout=None,
     Returns:
         exit code
     """
+    engine = get_engine()
+    if engine:
+        return engine.run(command, cwd, timeout, shell)
+
     os.environ["PYTHONUNBUFFERED"] = "1"
 
     # Make calls from subprocess timeout before main subprocess
@@ -52,51 +62,129 @@ def run_shell_cmd(command, cwd=None, timeout=None,
     return proc.returncode, out, err
 
 
-def make_filelist(dir: str) -> None:
-    os.chdir(dir)
-    path = dir.rstrip('/') + '-filelist.txt'
-    cmd = 'find -type f -not -path "./.*" | cut -c 3- > "' + path + '"'
-    subprocess.run(cmd,
-                   stderr=subprocess.DEVNULL,
-                   stdout=subprocess.DEVNULL,
-                   shell=True)
-
-
-def filelist_to_storage(dir: str,  store: Storage) -> int:
-
-    path = dir.rstrip('/') + '-filelist.txt'
-    table = etl.fromtext(path, header=['filename'], strip="\n")
-    table = etl.rename(
-        table,
-        {
-            'filename': 'path',
-            'filesize': 'size',
-            'Content_Type': 'mime',
-            'Version': 'version',
-        },
-        strict=False,
-    )
-    table = etl.select(table, lambda rec: rec.path != "")
-    table = add_fields(table, 'mime', 'version', 'status', 'puid', 'source_id')
-    # Remove Siegfried generated columns
-    table = remove_fields(table, "namespace", "basis", "warning")
+def human_size(size: float) -> str:
+    """Format number of bytes with unit"""
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def scan_files(dir: str, threads: int = 8):
+    """
+    Find files in folder and its subfolders, with stat data from the scan
+
+    Folders are read in parallel with `os.scandir`, and the files are
+    yielded as they're found, as tuples of path relative to `dir`, size,
+    modification time and inode. Symlinks, and hidden files and folders
+    directly in `dir`, are skipped
+    """
+    dir = os.path.normpath(dir)
+    prefix = os.path.join(dir, '')
+
+    def scan(path):
+        files, folders = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if path == dir and entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            files.append((entry.path[len(prefix):],
+                                          st.st_size, st.st_mtime,
+                                          st.st_ino))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+        return files, folders
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = {executor.submit(scan, dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                pending |= {executor.submit(scan, folder)
+                            for folder in folders}
+                yield from files
+
+
+def scan_to_storage(dir: str, store: Storage) -> int:
+    """
+    Add files in folder that aren't in the database already, and return
+    the number of files found
+
+    The files are inserted in chunks while the folder is scanned, with
+    size, modification time and inode
+    """
+    count = 0
+
+    def rows():
+        nonlocal count
+        for path, size, mtime, inode in scan_files(dir, cfg['scan-threads']):
+            count += 1
+            yield path, size, mtime, inode, 'new'
 
-    table = etl.update(table, 'status', "new")
+    store.add_new_rows(['path', 'size', 'mtime', 'inode', 'status'], rows())
 
-    # Treat csv (detected from extension only) as plain text:
-    table = etl.convert(table, "mime", lambda v,
-                        _row: "text/plain" if _row.id == "x-fmt/18" else v,
-                        pass_row=True)
+    return count
 
-    # Update for missing mime types where id is known:
-    table = etl.convert(table, "mime", lambda v,
-                        _row: "application/xml" if _row.id == "fmt/979" else v,
-                        pass_row=True)
 
-    store.append_rows(table)
-    row_count = etl.nrows(table)
-    os.remove(path)
-    return row_count
+def checksum(path: str, algorithm: str = None) -> str:
+    """
+    Get digest of file with `algorithm` from hashlib, by default the one
+    in `checksum: algorithm`, reading it a megabyte at a time
+    """
+    digest = hashlib.new(algorithm or cfg['checksum']['algorithm'])
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def copy_with_checksum(src_path: str, dest_path: str,
+                       algorithm: str = None) -> str:
+    """
+    Copy file like `shutil.copyfile`, and return its digest, made while
+    it's copied so that the file is only read once
+    """
+    digest = hashlib.new(algorithm or cfg['checksum']['algorithm'])
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        for chunk in iter(lambda: src.read(1024 * 1024), b''):
+            digest.update(chunk)
+            dest.write(chunk)
+
+    return digest.hexdigest()
+
+
+def link_file(src_path: str, dest_path: str, method: str) -> None:
+    """
+    Make `dest_path` a hardlink, reflink or copy of `src_path`, as set by
+    `method`. The file is copied if it can't be linked
+    """
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+    if method == 'hardlink':
+        try:
+            os.link(src_path, dest_path)
+            return
+        except OSError:
+            pass
+    elif method == 'reflink':
+        result = subprocess.run(['cp', '--reflink=always', src_path,
+                                 dest_path], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            return
+
+    shutil.copy2(src_path, dest_path)
 
 
 def remove_file(src_path: str) -> None:
@@ -125,48 +213,126 @@ def extract_nested_zip(zipped_file: str, to_folder: str) -> None:
                 extract_nested_zip(filespec, root)
 
 
+def uno_server_ports() -> list[int]:
+    """Get the ports of the configured unoserver instances"""
+    port = cfg['unoserver']['port']
+    # Every instance uses two ports, the one below for LibreOffice
+    return [port + 2 * i for i in range(cfg['unoserver']['instances'])]
+
+
 def start_uno_server():
-    if uno_server_running():
+    """Start the unoserver instances that aren't already running"""
+    ports = [port for port in uno_server_ports()
+             if not uno_server_running(port)]
+    if not ports:
         return
 
-    started = False
+    for port in ports:
+        start_uno_instance(port)
+
+    print('starting unoserver ...')
+    while not all(uno_server_running(port) for port in ports):
+        time.sleep(1)
+
+    return
+
+
+def start_uno_instance(port: int) -> None:
+    """Start unoserver on port with a user profile of its own"""
+    profile = Path(tempfile.gettempdir(), 'pwconvert', f'unoserver-{port}')
+    cmd = ['unoserver', '--port', str(port), '--uno-port', str(port - 1),
+           '--user-installation', profile.as_uri()]
     subprocess.Popen(
-        'unoserver',
+        cmd,
         start_new_session=True,
         close_fds=True,
+        stdin=subprocess.DEVNULL,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.STDOUT,
     )
 
-    print('starting unoserver ...')
-    while not started:
-        time.sleep(1)
-        if uno_server_running():
-            started = True
 
-    return
-
-
-def uno_server_running():
-    for process in psutil.process_iter():
-        if process.name() in ['soffice', 'soffice.bin']:
+def uno_server_running(port: int) -> bool:
+    """Check if unoserver listens on port"""
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
             return True
+    except OSError:
+        return False
 
-    return False
 
+def uno_server_responding(port: int) -> bool:
+    """Check if unoserver on port can convert a small document in time"""
+    cmd = ['unoconvert', '--port', str(port), '--convert-to', 'txt', '-', '-']
+    try:
+        proc = subprocess.run(cmd, input=b'pwconvert', capture_output=True,
+                              timeout=cfg['unoserver']['probe-timeout'],
+                              start_new_session=True)
+    except subprocess.TimeoutExpired:
+        return False
+
+    return proc.returncode == 0
+
+
+def restart_uno_instance(port: int) -> None:
+    """Kill unoserver on port together with its LibreOffice, and start it again"""
+    for process in psutil.process_iter(['cmdline']):
+        cmdline = process.info['cmdline'] or []
+        if 'unoserver' not in ' '.join(cmdline[:2]) or '--port' not in cmdline:
+            continue
+        if cmdline[cmdline.index('--port') + 1:][:1] != [str(port)]:
+            continue
+        try:
+            for child in process.children(recursive=True):
+                child.kill()
+            process.kill()
+            process.wait(5)
+        except psutil.Error:
+            pass
+
+    print(f"\nrestarting unoserver on port {port} ...", flush=True)
+    start_uno_instance(port)
+    while not uno_server_running(port):
+        time.sleep(1)
 
-def remove_fields(table, *args):
-    """Remove fields from petl table"""
-    for field in args:
-        if field in etl.fieldnames(table):
-            table = etl.cutout(table, field)
-    return table
 
+def kill_children(pid: int) -> None:
+    """Kill all processes started by process `pid`, with their process groups"""
+    try:
+        children = psutil.Process(pid).children(recursive=True)
+    except psutil.Error:
+        return
+    for child in children:
+        try:
+            if os.getpgid(child.pid) == child.pid:
+                os.killpg(child.pid, signal.SIGKILL)
+            else:
+                child.kill()
+        except (OSError, psutil.Error):
+            pass
 
-def add_fields(table, *args):
-    """Add fields to petl table"""
-    for field in args:
-        if field not in etl.fieldnames(table):
-            table = etl.addfield(table, field, None)
-    return table
 
+def watch_uno_servers(queues, stop, interval: int) -> None:
+    """
+    Probe idle unoserver instances, and restart those that don't respond
+
+    Takes the free instances from the slot queues, so that no conversion
+    is sent to an instance while it's probed
+    """
+    while not stop.wait(interval):
+        for q in queues:
+            ports = []
+            while True:
+                try:
+                    ports.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            for port in ports:
+                if not uno_server_responding(port):
+                    restart_uno_instance(port)
+                q.put(port)
+
+
+def set_uno_port(cmd: str, port: int) -> str:
+    """Make unoconvert in command use the unoserver instance on port"""
+    return re.sub(r'\bunoconvert\b(?! --port)', f'unoconvert --port {port}', cmd)
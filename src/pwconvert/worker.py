@@ -0,0 +1,144 @@
+import os
+import socket
+import datetime
+import threading
+import time
+from pathlib import Path
+import typer
+from rich.console import Console
+
+from .storage import Storage
+from .convert import convert_rows, print_summary
+from .util import start_uno_server, scan_to_storage
+from .config import cfg
+
+app = typer.Typer(rich_markup_mode="rich")
+console = Console()
+cwd = os.getcwd()
+
+
+@app.command()
+def worker(
+    source: str,
+    dest: str = typer.Option(default=None, help="Path to destination folder"),
+    db: str = typer.Option(default=None, help="Name of MySQL base"),
+    orig_ext: bool = typer.Option(default=cfg['keep-original-ext'],
+                                  help="Keep original extension"),
+    debug: bool = typer.Option(default=cfg['debug'], help="Turn on debug"),
+    mime: str = typer.Option(default=None, help="Filter on mime-type"),
+    puid: str = typer.Option(default=None,
+                             help="Filter on PRONOM Unique Identifier"),
+    ext: str = typer.Option(default=None, help="Filter on file extension"),
+    status: str = typer.Option(
+        default=None,
+        help="Filter on conversion status"
+    ),
+    identify_only: bool = typer.Option(
+        default=False, help="Don't convert, only identify files"
+    ),
+    retry: bool = typer.Option(
+        default=False,
+        help="Try to convert files where conversion previously failed"
+    ),
+    keep_originals: bool = typer.Option(
+        default=cfg['keep-original-files'],
+        help="Keep original files"
+    ),
+    batch: int = typer.Option(
+        default=cfg['worker']['batch'],
+        help="Number of files to lease at a time"
+    ),
+    lease: int = typer.Option(
+        default=cfg['worker']['lease'],
+        help="Seconds until leased files can be claimed by other workers"
+    ),
+    max_in_flight: int = typer.Option(
+        default=cfg['max-in-flight'],
+        help="Max number of files submitted to the workers at a time"
+    ),
+    adaptive: bool = typer.Option(
+        default=False,
+        help="Adjust number of simultaneous conversions to system load"
+    )
+) -> None:
+    """
+    Convert files in SOURCE folder together with other workers
+
+    Any number of workers, on one or several hosts, can convert the same
+    collection when they use the same database. Each worker leases
+    batches of files, and renews the leases while converting them.
+    Files leased by a worker that stops are claimed by other workers
+    when the lease expires.
+
+    For a new collection, start one worker and let it register the files
+    before starting the others.
+    If --dest is not set, then the conversion is done inside the SOURCE
+    folder. If --db is not set, it uses a SQLite base with path like
+    --dest and .db extension.
+    """
+
+    if source[0] != '/':
+        source = os.path.join(cwd, source)
+    if dest and dest[0] != '/':
+        dest = os.path.join(cwd, dest)
+    dest = dest or source
+
+    Path(dest).mkdir(parents=True, exist_ok=True)
+    ts = datetime.datetime.now()
+
+    if not db:
+        db = dest.rstrip('/') + '.db'
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    with Storage(db) as store:
+        if store.get_row_count() == 0:
+            scan_to_storage(source, store)
+            status = 'new'
+
+        conds, params = store.get_conds(mime=mime, puid=puid, status=status,
+                                        timestamp=ts, ext=ext, retry=retry)
+        count_remains = store.get_row_count(conds, params)
+
+        if not identify_only:
+            start_uno_server()
+
+        console.print(f"Worker {owner} starts on {count_remains} remaining files",
+                      style="bold cyan")
+
+        stop = threading.Event()
+        renewer = threading.Thread(target=renew_leases,
+                                   args=(db, owner, lease, ts, stop),
+                                   daemon=True)
+        renewer.start()
+
+        rows = claim_batches(store, conds, params, owner, batch, lease)
+        t0 = time.time()
+        try:
+            convert_rows(store, rows, count_remains, db, source, dest,
+                         orig_ext, debug, identify_only=identify_only,
+                         keep_originals=keep_originals,
+                         max_in_flight=max_in_flight, adaptive=adaptive,
+                         lease=(owner, lease))
+        finally:
+            stop.set()
+            renewer.join()
+            store.release_leases(owner)
+
+        print_summary(store, db, ts, t0, identify_only)
+
+
+def claim_batches(store, conds, params, owner, batch, lease):
+    """Lease batches of rows until there are no free rows left"""
+    while True:
+        rows = store.claim_rows(conds, params, owner, lease, batch)
+        if not rows:
+            return
+        yield from rows
+
+
+def renew_leases(db, owner, lease, ts, stop):
+    """Renew leases of unfinished rows until `stop` is set"""
+    with Storage(db) as store:
+        while not stop.wait(lease / 3):
+            store.renew_leases(owner, lease, ts)